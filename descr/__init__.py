@@ -1,6 +1,8 @@
 
 from .format import (descr, Formatter, Printer,
-                     RuleBuilder, DescriptionProcessor)
+                     RuleBuilder, DescriptionProcessor,
+                     register_descr, unregister_descr, Budget,
+                     track_references, FragmentCache)
 
 # from .terminal import std_terminal
 
@@ -0,0 +1,80 @@
+
+# Class sets are built for every node of every description, and most
+# of them are the same few sets over and over again ({"@int",
+# "scalar"}, {"assoc"}, ...). intern_classes returns a canonical
+# frozenset for a class set so that they can be shared, compared by
+# identity and hashed only once (frozensets cache their hash).
+
+interned = {}
+max_interned = 100000
+
+def intern_classes(classes):
+    classes = frozenset(classes)
+    try:
+        return interned[classes]
+    except KeyError:
+        if len(interned) >= max_interned:
+            interned.clear()
+        interned[classes] = classes
+        return classes
+
+def class_set(*classes):
+    return intern_classes(classes)
+
+
+class ClassTable(object):
+    """
+    Maps class names to small integers, so that a set of classes can
+    be represented as an integer where bit i is set if the class with
+    id i is in the set. Bitsets are cached per class set, so
+    bitset() takes frozensets, ideally interned ones.
+
+    If the table is frozen, names that are not in the table are
+    ignored by bitset() instead of being given a new id.
+    """
+
+    def __init__(self, names = (), frozen = False, maxsize = 10000):
+        self.ids = {}
+        self.names = []
+        for name in names:
+            self.id(name)
+        self.frozen = frozen
+        self.maxsize = maxsize
+        self.bitsets = {}
+
+    def id(self, name):
+        try:
+            return self.ids[name]
+        except KeyError:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+            return i
+
+    def bitset(self, classes):
+        try:
+            return self.bitsets[classes]
+        except KeyError:
+            pass
+        bits = 0
+        ids = self.ids
+        for name in classes:
+            i = ids.get(name)
+            if i is None:
+                if self.frozen:
+                    continue
+                i = self.id(name)
+            bits |= 1 << i
+        if len(self.bitsets) >= self.maxsize:
+            self.bitsets.clear()
+        self.bitsets[classes] = bits
+        return bits
+
+    def classes(self, bits):
+        # Converts a bitset back to a set of class names.
+        names = self.names
+        rval = []
+        while bits:
+            low = bits & -bits
+            bits ^= low
+            rval.append(names[low.bit_length() - 1])
+        return intern_classes(rval)
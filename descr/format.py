@@ -1,18 +1,81 @@
 
 import re
+import time
 import itertools
-from .registry import types_registry
+from .registry import types_registry, register_descr, unregister_descr
+from .classes import intern_classes, class_set
+from .rules import pure, is_pure, reads_children, call_rule
+
+
+class Deferred(object):
+    """
+    Stands for the description of datum, descr(datum, recurse), which
+    is computed by force(). See describe().
+    """
+
+    __slots__ = ("datum", "descr", "recurse", "forced", "value")
+
+    def __init__(self, datum, descr, recurse):
+        self.datum = datum
+        self.descr = descr
+        self.recurse = recurse
+        self.forced = False
+        self.value = None
+
+    def force(self):
+        if not self.forced:
+            self.value = self.descr(self.datum, self.recurse)
+            self.forced = True
+        return self.value
+
+    def __iter__(self):
+        return iter(undefer(self))
+
+    def release(self):
+        # Drops the description so that it can be freed. It will be
+        # computed again if the Deferred is forced again.
+        self.forced = False
+        self.value = None
+
+def undefer(x):
+    while isinstance(x, Deferred):
+        x = x.force()
+    return x
+
+def undefer_all(children):
+    # What rule functions are given as children: their descriptions.
+    # The Deferred objects keep them, so they are only computed once.
+    # Children a Budget must check when they are processed are given
+    # as they are, without checking (see Budget.truncate).
+    return [child.datum if isinstance(child, Checked) else undefer(child)
+            for child in children]
 
 
 def exhaust_stream(stream):
-    classes = set()
+    # The classes are returned as an interned frozenset. In the common
+    # case where the stream contains a single set of classes, that set
+    # is interned directly instead of being copied. Deferred entries
+    # are children (recurse() never returns classes), so they are left
+    # as they are for DescriptionProcessor to force when it gets to
+    # them.
+    classes = None
+    owned = False
     parts = []
     distribute = []
 
     for entry in stream:
         if isinstance(entry, (set, frozenset)):
-            classes.update(entry)
+            if classes is None:
+                classes = entry
+            else:
+                if not owned:
+                    classes = set(classes)
+                    owned = True
+                classes.update(entry)
         elif isinstance(entry, dict):
+            if not owned:
+                classes = set(classes or ())
+                owned = True
             for klass in entry.get(True, ()):
                 classes.add(klass)
             for klass in entry.get(False, ()):
@@ -22,80 +85,294 @@ def exhaust_stream(stream):
         else:
             parts.append(entry)
 
+    classes = intern_classes(classes or ())
+
     if distribute:
         parts = [distribute + [part] if isinstance(part, str)
                  else itertools.chain(distribute, part)
-                 for part in parts]
+                 for part in map(undefer, parts)]
 
     return classes, parts
 
 
+class Fragment(object):
+    """
+    Output generated for a description, as stored in a FragmentCache.
+    Formatters put value in their output as it is.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class FragmentCache(object):
+    """
+    Opt-in cache of the output formatters generate for scalars (None,
+    bools, ints and strings of up to 64 characters). Entries are keyed
+    on the descr function that describes the scalar, its type and
+    value, and the explorer of its parent, which stands for the rules
+    in effect there. When DescriptionProcessor meets a scalar that is
+    in the cache, it puts the Fragment in place of its description, so
+    that it is not described, processed or generated again. The
+    functions in the rules (and descr) must therefore give the same
+    result for the same scalar, and rules on a parent will see the
+    Fragment rather than a processed description.
+
+    Formatters clear() the cache when their rules change. It is also
+    cleared when types_registry changes and when it holds maxsize
+    entries. Data described under a Budget are not cached, since how
+    they are described depends on how much of the budget is left.
+    """
+
+    types = (type(None), bool, int, str)
+
+    def __init__(self, maxsize = 10000):
+        self.maxsize = maxsize
+        self.entries = {}
+        self.generation = types_registry.generation
+
+    def clear(self):
+        self.entries.clear()
+
+    def check(self):
+        # To call before each use.
+        if self.generation != types_registry.generation:
+            self.generation = types_registry.generation
+            self.clear()
+
+    def key(self, deferred, rules):
+        # Key for the Deferred description of a child of a node with
+        # the given explorer, or None if it can't be cached.
+        datum = deferred.datum
+        t = type(datum)
+        if t not in self.types \
+                or (t is str and len(datum) > 64) \
+                or getattr(deferred.descr, "stateful", False):
+            return None
+        return (deferred.descr, t, datum, rules)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def store(self, key, value):
+        if len(self.entries) >= self.maxsize:
+            self.entries.clear()
+        self.entries[key] = Fragment(value)
+
+
 class DescriptionProcessor(object):
 
+    # The properties phase1, phase2 and phase3 act upon. Nodes whose
+    # rules set none of them skip these phases (see RuleTreeExplorer.names).
+    phase_properties = frozenset([":hide", ":rearrange", ":before", ":after",
+                                  ":raw", ":post"])
+
+    # The FragmentCache to use (on the root), and the key under which
+    # process_children found a node, if it can be cached
+    fragments = None
+    fragment_key = None
+    # True if this node or one of its ancestors has :inspect. The HTML
+    # generated for its children may then be described again, so they
+    # must not be Fragments, and they are not cached either.
+    under_inspect = False
+
     @classmethod
-    def process(cls, obj, parent_rules):
+    def process(cls, obj, parent_rules, fragments = None):
+        obj = undefer(obj)
+        if isinstance(obj, Rest):
+            obj = obj.elision()
         if isinstance(obj, (str, int, float)):
             return obj
         elif isinstance(obj, (set, frozenset)):
             raise ValueError("Not expecting a set here.", obj)
         else:
-            return cls(obj, parent_rules)
+            return cls(obj, parent_rules, fragments = fragments)
 
-    def __init__(self, description, parent_rules):
+    def __init__(self, description, parent_rules, _root = True, fragments = None):
         classes, children = exhaust_stream(description)
-        rules, children = parent_rules.explore(classes, children)
+        rules, children = parent_rules.explore(classes, children, undefer_all)
         self.rules = rules
         self.classes = rules.classes
         self.properties = rules.properties
-        self.children = children
-        self.phase1()
-        self.phase2()
-        self.phase3()
+        if ":inspect" in rules.names:
+            self.under_inspect = True
+        if rules.names.isdisjoint(self.phase_properties):
+            self.children = list(children)
+        else:
+            self.children = children
+            self.phase1()
+            self.phase2()
+        if _root:
+            self.fragments = fragments
+            self.process_children()
+
+    def process_children(self):
+        # The children are processed with an explicit stack rather than
+        # recursively, so that the depth of the description is only
+        # limited by memory. Each entry is a node along with the index
+        # of the next child of that node to process. Nodes below the
+        # root are created with _root = False so that they leave
+        # their children to this loop.
+        fragments = self.fragments
+        cls = type(self)
+        stack = [[self, 0]]
+        while stack:
+            entry = stack[-1]
+            node, i = entry
+            children = node.children
+            if i < len(children):
+                entry[1] = i + 1
+                child = children[i] = node.process_child(children[i], fragments, i)
+                if isinstance(child, cls):
+                    stack.append([child, 0])
+            else:
+                if ":post" in node.rules.names:
+                    node.phase3()
+                stack.pop()
+
+    def process_child(self, child, fragments = None, index = None):
+        # Processes child, a child of this node, but not its own
+        # children: strings and numbers are returned as they are, a
+        # Fragment is returned if fragments has one for child (and we
+        # are not under_inspect), and a new node otherwise. If child is a Rest, it and the children
+        # after it (from index on) are replaced by a single elision.
+        key = None
+        if isinstance(child, Deferred):
+            if fragments is not None and not self.under_inspect:
+                key = fragments.key(child, self.rules)
+                fragment = key and fragments.get(key)
+                if fragment is not None:
+                    return fragment
+            child = undefer(child)
+        if isinstance(child, Rest):
+            if index is None:
+                child = child.elision()
+            else:
+                child = rest_elision(child, self.children, index)
+        if isinstance(child, (str, int, float)):
+            return child
+        elif isinstance(child, (set, frozenset)):
+            raise ValueError("Not expecting a set here.", child)
+        child = type(self)(child, self.rules, False)
+        child.fragment_key = key
+        if self.under_inspect:
+            child.under_inspect = True
+        return child
+
+    @classmethod
+    def walk(cls, obj, parent_rules, whole = ()):
+        """
+        Processes obj like process(), but yields the result as it goes
+        instead of building a tree, so that only the nodes on the path
+        to the current one are kept alive:
+
+        * ("enter", node) before the children of a node,
+        * ("exit", node) after them,
+        * ("leaf", x) for a child that is a string or a number,
+        * ("whole", node) for a node that has :post or one of the
+          properties in whole, which need all the children of the
+          node, so they are processed as by process().
+
+        The children of a node that is entered are dropped as they
+        are processed, as are the descriptions Deferred objects
+        computed for them (see Deferred.release).
+        """
+        whole = frozenset(whole) | {":post"}
+        obj = undefer(obj)
+        if isinstance(obj, Rest):
+            obj = obj.elision()
+        if isinstance(obj, (str, int, float)):
+            yield "leaf", obj
+            return
+        elif isinstance(obj, (set, frozenset)):
+            raise ValueError("Not expecting a set here.", obj)
+        node = cls(obj, parent_rules, False)
+        stack = []
+        while node is not None:
+            if node.rules.names.isdisjoint(whole):
+                yield "enter", node
+                stack.append([node, 0])
+            else:
+                node.process_children()
+                yield "whole", node
+            node = None
+            while stack and node is None:
+                entry = stack[-1]
+                parent, i = entry
+                children = parent.children
+                if i < len(children):
+                    entry[1] = i + 1
+                    child = children[i]
+                    children[i] = None
+                    result = parent.process_child(child, None, i)
+                    if isinstance(child, Deferred):
+                        child.release()
+                    if isinstance(result, cls):
+                        node = result
+                    else:
+                        yield "leaf", result
+                else:
+                    stack.pop()
+                    yield "exit", parent
+
+    def call(self, f):
+        # Calls the rule function f on this node. The children it may
+        # read are forced (see undefer_all).
+        if reads_children(f):
+            return call_rule(f, self.classes, undefer_all(self.children))
+        return call_rule(f, self.classes, self.children)
 
     def phase1(self):
 
         props = self.properties
 
         for f in props.get(":hide", ()):
-            if f(self.classes, self.children):
-                self.classes = {}
+            if self.call(f):
+                self.classes = intern_classes(())
                 self.children = []
                 return
 
         for f in props.get(":rearrange", ()):
-            self.children = f(self.classes, self.children)
+            self.children = self.call(f)
 
         before_acc = []
         for f in props.get(":before", ()):
-            before_acc = [f(self.classes, self.children)] + before_acc
+            before_acc = [self.call(f)] + before_acc
 
         after_acc = []
         for f in props.get(":after", ()):
-            after_acc += [f(self.classes, self.children)]
+            after_acc += [self.call(f)]
 
         if before_acc or after_acc:
             self.children = list(itertools.chain(before_acc, self.children, after_acc))
 
     def phase2(self):
+        # Prepares the children for processing. The processing itself
+        # is done by process_children.
         raw = self.properties.get(":raw", False)
 
         if raw and raw[-1]:
-            self.children = list(map(str, parts))
+            self.children = [str(undefer(child)) for child in self.children]
         else:
-            self.children = [self.process(child, self.rules)
-                             for child in self.children]
+            self.children = list(self.children)
 
     def phase3(self):
 
         props = self.properties
 
         for f in props.get(":post", ()):
-            self.children = f(self.classes, self.children)
+            self.children = call_rule(f, self.classes, self.children)
 
 
 
 class Formatter(object):
-    pass
+
+    def translate_iter(self, stream):
+        # Formatters that can produce their output incrementally
+        # should override this to yield it in chunks.
+        yield self.translate(stream)
 
 
 class RawFormatter(Formatter):
@@ -107,29 +384,63 @@ class RawFormatter(Formatter):
 
 class Printer(object):
 
-    def __init__(self, port, descr, formatter):
+    def __init__(self, port, descr, formatter, flush_size = 65536, budget = None):
         self.port = port
         self.descr = descr
         self.formatter = formatter
-
-    def translate(self, stream, rules = None):
+        # If budget is a Budget, it limits how much of the objects
+        # given to pr() is described.
+        self.budget = budget
+        # write() accumulates at least flush_size characters before
+        # writing them to the port. If flush_size is None, everything
+        # is written at once.
+        self.flush_size = flush_size
+
+    def get_formatter(self, rules = None):
         if rules is not None:
             formatter = self.formatter.copy()
             formatter.add_rules(rules)
+            return formatter
         else:
-            formatter = self.formatter
-        return formatter.translate(stream)
+            return self.formatter
+
+    def translate(self, stream, rules = None):
+        return self.get_formatter(rules).translate(stream)
+
+    def translate_iter(self, stream, rules = None):
+        # Formatters that don't derive from Formatter may only have
+        # translate, in which case the output comes in one chunk
+        formatter = self.get_formatter(rules)
+        translate_iter = getattr(formatter, "translate_iter", None)
+        if translate_iter is None:
+            return iter([formatter.translate(stream)])
+        return translate_iter(stream)
 
     def write(self, stream, rules = None):
-        s = self.translate(stream, rules)
-        self.port.write(s)
+        if self.flush_size is None:
+            self.port.write(self.translate(stream, rules))
+            return
+        buf = []
+        size = 0
+        for chunk in self.translate_iter(stream, rules):
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= self.flush_size:
+                self.port.write("".join(buf))
+                buf = []
+                size = 0
+        if buf:
+            self.port.write("".join(buf))
 
     def pr(self, *objects, **kwargs):
         if "descr" in kwargs:
             descr = kwargs.pop("descr")
         else:
             descr = self.descr
-        d = [descr(obj) for obj in objects]
+        budget = kwargs.pop("budget", self.budget)
+        if budget is not None:
+            budget = budget.start()
+        d = [describe(obj, descr, budget) for obj in objects]
         self.write(d, **kwargs)
 
     __call__ = pr
@@ -203,15 +514,21 @@ class RuleBuilder(RulesRegistry):
     def prop(self, selector, prop, value):
         return self.rule(selector, {prop: value})
 
+    # Marks a rule function as pure (see rules.pure), e.g.
+    # rb.pclasses(".x", rb.pure(f, "scalars"))
+    pure = staticmethod(pure)
+
     def fprop(self, selector, prop, value, f = None, elsevalue = None):
         if f is not None:
             v = lambda c, d: value if f(c, d) else elsevalue
+            if is_pure(f) and not callable(value):
+                pure(v, is_pure(f))
         elif callable(value):
             v = value
         elif value is None:
             v = None
         else:
-            v = lambda c, d: value
+            v = pure(lambda c, d: value)
         return self.rule(selector, {prop: v})
 
     def rule(self, selector, props1 = {}, **props2):
@@ -236,7 +553,7 @@ class RuleBuilder(RulesRegistry):
         if not isinstance(m, set): m = {m}
         return self.rule(selector,
                          {":classes":
-                              lambda classes, children: (classes | p) - m})
+                              pure(lambda classes, children: (classes | p) - m)})
 
     def replace(self, selector, value, f = None):
         return self.fprop(selector, ":replace", value, f, [])
@@ -252,7 +569,7 @@ class RuleBuilder(RulesRegistry):
 
     def hide(self, selector, f = None):
         if f is None:
-            f = lambda c, p: True
+            f = pure(lambda c, p: True)
         return self.fprop(selector, ":hide", f)
 
     def inspect(self, selector, f = None):
@@ -304,30 +621,369 @@ class Layout(object):
 
 
 def descr(datum, recurse = None):
+    # Sub-data are described eagerly unless recurse says otherwise;
+    # describe() describes them lazily, so that the parts of datum
+    # that the rules hide are never described.
     recurse = recurse or descr
-
-    try:
-        # I believe this is what str() and repr() do otherwise
-        # representation of class objects wouldn't be customizable
-        f = type(datum).__descr__
-    except AttributeError:
-        for t in type(datum).__mro__:
-            if t in types_registry:
-                return types_registry[t](datum, recurse)
-        else:
-            return str(datum)
+    # The handler is type(datum).__descr__ if it exists, else the
+    # entry in types_registry for the closest type in the mro (see
+    # TypesRegistry.handler). We look __descr__ up on the type, which
+    # I believe is what str() and repr() do, otherwise representation
+    # of class objects wouldn't be customizable.
+    return types_registry.handler(type(datum))(datum, recurse)
+
+
+def describe(datum, descr = descr, budget = None):
+    """
+    Equivalent to descr(datum), but without recursion, so that the
+    depth of datum is only limited by memory. descr must accept a
+    recurse argument like descr.descr does.
+
+    Instead of describing sub-data as they are met, the recurse
+    function given to descr returns Deferred objects, which are only
+    described when they are needed. DescriptionProcessor knows to look
+    through them (see undefer), so sub-data that are hidden by the
+    rules are never described.
+
+    If budget is given, it should be a started Budget (see
+    Budget.start), which decides how much of datum is described.
+    """
+    if budget is not None:
+        return budget.describe(datum, descr)
+    def recurse(x):
+        return Deferred(x, descr, recurse)
+    return descr(datum, recurse)
+
+
+def elision(reason, count = None):
+    """
+    Description of the part of a datum that was left out because
+    Budget ran out of reason ("depth", "items", "nodes", "size" or
+    "time"). count is how many elements were left out, if it is known.
+    """
+    classes = class_set("elided", "elided-" + reason)
+    if count is None:
+        return (classes, "...")
     else:
-        # Executed only if there was a __descr__ and won't mask
-        # exceptions.
-        return f(datum, recurse)
+        return (classes, "... %s more" % count)
+
+
+class Rest(object):
+    """
+    Stands for count children that a Budget left out because it ran
+    out of reason, along with the children that come after it: when
+    DescriptionProcessor meets it, it replaces them all by a single
+    elision (see rest_elision).
+    """
+
+    __slots__ = ("reason", "count")
+
+    def __init__(self, reason, count = 1):
+        self.reason = reason
+        self.count = count
+
+    def elision(self):
+        return elision(self.reason, self.count)
+
+
+def rest_elision(rest, children, index):
+    # The elision for rest, found at children[index]. The children
+    # after it are removed (other Rest objects among them stand for
+    # their count).
+    count = rest.count
+    for child in itertools.islice(children, index + 1, None):
+        count += child.count if isinstance(child, Rest) else 1
+    del children[index + 1:]
+    return elision(rest.reason, count)
+
+
+class _Limited(object):
+    # The recurse function Budget gives to descr for a datum of which
+    # at most limit elements should be described. The handlers of the
+    # builtin containers only describe that many (see
+    # registry.describe_elements) and put elided(n) in place of the
+    # others.
+
+    __slots__ = ("recurse", "limit", "count")
+
+    def __init__(self, recurse, limit):
+        self.recurse = recurse
+        self.limit = limit
+        self.count = 0
+
+    def __call__(self, x):
+        return self.recurse(x)
+
+    def elided(self, count):
+        self.count += count
+        return _elided
+
+
+# Placeholder for the elements _Limited.elided stands for
+_elided = object()
+
+
+class Checked(Deferred):
+    # A child of a description that a Budget truncated and that it
+    # did not describe itself: forcing it checks that the budget did
+    # not run out in the meantime (see Budget.check).
+    __slots__ = ()
+
+
+class Budget(object):
+    """
+    Limits on how much of a datum describe() describes:
+
+    * max_depth: sub-data nested more than max_depth levels deep.
+    * max_items: children of a description beyond the first max_items.
+    * max_nodes: total number of calls to descr.
+    * max_output_bytes: total length of the strings in the
+      descriptions (the output itself will be longer, but it is
+      roughly proportional).
+    * timeout: time in seconds after which we stop describing.
+
+    All limits are optional. Whatever is left out is described by
+    elision(), so that rules can style it (it has the class
+    "elided"). The limits are checked before a datum is described, so
+    the parts that are left out cost nothing: the children beyond
+    max_items (or the nodes left) are not even visited for builtin
+    containers, and once the budget runs out, the first child that
+    DescriptionProcessor gets to is a Rest, which stands for it and
+    all its siblings after it.
+
+    The counters are kept on the object returned by start(), which
+    Printer calls once for each pr().
+    """
+
+    def __init__(self,
+                 max_depth = None,
+                 max_items = None,
+                 max_nodes = None,
+                 max_output_bytes = None,
+                 timeout = None):
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_nodes = max_nodes
+        self.max_output_bytes = max_output_bytes
+        self.timeout = timeout
+        self.nodes = 0
+        self.size = 0
+        self.deadline = None
+        self.recursers = {}
+
+    def start(self):
+        rval = Budget(self.max_depth,
+                      self.max_items,
+                      self.max_nodes,
+                      self.max_output_bytes,
+                      self.timeout)
+        if self.timeout is not None:
+            rval.deadline = time.time() + self.timeout
+        return rval
+
+    def exhausted(self):
+        # Returns the reason why we can't describe anything anymore,
+        # or None if we still can.
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            return "nodes"
+        if self.max_output_bytes is not None and self.size >= self.max_output_bytes:
+            return "size"
+        if self.deadline is not None and time.time() >= self.deadline:
+            return "time"
+        return None
+
+    def recurser(self, descr, depth):
+        # The recurse function for sub-data at the given depth. The
+        # Deferred objects it returns call describe(datum, descr) when
+        # they are forced, with describe bound to that depth.
+        try:
+            return self.recursers[descr, depth]
+        except KeyError:
+            def describe(datum, descr):
+                return self.describe(datum, descr, depth)
+            # See FragmentCache
+            describe.stateful = True
+            def recurse(x):
+                return Deferred(x, describe, descr)
+            self.recursers[descr, depth] = recurse
+            return recurse
+
+    def check(self, description, _ = None):
+        # description, or a Rest if we ran out. Children that are not
+        # described by a recurser (e.g. the entries of a dict) go
+        # through this when they are forced.
+        reason = self.exhausted()
+        if reason:
+            return Rest(reason)
+        return description
+
+    def describe(self, datum, descr, depth = 0):
+        if self.max_depth is not None and depth > self.max_depth:
+            return elision("depth")
+        reason = self.exhausted()
+        if reason:
+            return Rest(reason)
+        self.nodes += 1
+        recurse = self.recurser(descr, depth + 1)
+        max_items = self.max_items
+        if self.max_nodes is None:
+            nodes_left = None
+        else:
+            nodes_left = max(self.max_nodes - self.nodes, 0)
+        if max_items is None and nodes_left is None:
+            d = descr(datum, recurse)
+        else:
+            # Every child that is not a string will cost a node when
+            # it is described, so we won't keep more than nodes_left
+            recurse = _Limited(recurse, min(n for n in (max_items, nodes_left)
+                                            if n is not None))
+            d = descr(datum, recurse)
+        if isinstance(d, (str, int, float)):
+            self.size += len(str(d))
+            return d
+        if max_items is None and nodes_left is None and self.max_output_bytes is None:
+            return d
+        return self.truncate(d, max_items, nodes_left, recurse)
+
+    def truncate(self, description, max_items, nodes_left, recurse):
+        # Keeps the classes of the description and up to max_items
+        # children, of which up to nodes_left are not strings. The
+        # children that are left out, including those the handler of a
+        # builtin container left out (see _Limited), are replaced by a
+        # single elision, where the first of them was. Children that
+        # are not strings or Deferred objects are checked against the
+        # budget when they are forced.
+        entries = []
+        items = 0
+        nodes = 0
+        elided = 0
+        position = None
+        reason = None
+        for entry in description:
+            if isinstance(entry, (set, frozenset, dict)):
+                entries.append(entry)
+                continue
+            if entry is _elided:
+                elided += recurse.count
+                if max_items is not None and items >= max_items:
+                    reason = reason or "items"
+                else:
+                    reason = reason or "nodes"
+            elif max_items is not None and items >= max_items:
+                reason = reason or "items"
+                elided += 1
+            elif isinstance(entry, str):
+                self.size += len(entry)
+                items += 1
+                entries.append(entry)
+                continue
+            elif nodes_left is not None and nodes >= nodes_left:
+                reason = reason or "nodes"
+                elided += 1
+            else:
+                items += 1
+                nodes += 1
+                if not isinstance(entry, (Deferred, int, float)):
+                    entry = Checked(entry, self.check, None)
+                entries.append(entry)
+                continue
+            if position is None:
+                position = len(entries)
+                entries.append(None)
+        if position is not None:
+            entries[position] = Rest(reason, elided)
+        return entries
 
 
 def augment_with_idclass(descr):
-    def descr2(obj):
-        d = descr(obj, descr2)
+    def descr2(obj, recurse = None):
+        d = descr(obj, recurse or descr2)
         if not isinstance(d, str):
             d = itertools.chain([{"#"+str(id(obj))}], d)
         return d
     return descr2
 
 
+# Instances of these types are not tracked by track_references: they
+# can't contain references and sharing them is meaningless (small
+# ints, for instance, are all shared).
+untracked_types = (str, bytes, int, float, complex, bool, type(None))
+
+class Occurrence(object):
+    """
+    A datum found at some place in the description of a root datum,
+    by track_references. seen holds the ids of the data described so
+    far from the root (it is only filled when shared is True).
+    """
+
+    __slots__ = ("datum", "parent", "seen")
+
+    def __init__(self, datum, parent = None):
+        self.datum = datum
+        self.parent = parent
+        if parent is None:
+            self.seen = set()
+        else:
+            self.seen = parent.seen
+
+    def in_cycle(self):
+        # Whether the datum is also that of one of our ancestors,
+        # which takes time proportional to our depth
+        node = self.parent
+        while node is not None:
+            if node.datum is self.datum:
+                return True
+            node = node.parent
+        return False
+
+
+def backref(datum, kind):
+    # kind is "cycle" or "shared"
+    return (class_set("backref", "backref-" + kind),
+            {"#" + str(id(datum))},
+            "<%s %s>" % (kind, type(datum).__name__))
+
+def track_references(descr, shared = False):
+    """
+    Wraps descr so that a datum that contains itself is described as a
+    back reference where it appears inside itself, instead of forever.
+    If shared is True, every datum is described only once and all the
+    other places it appears at are back references, so that the
+    description of a graph is proportional to the number of distinct
+    objects in it. Back references have the classes "backref" and
+    "backref-cycle" or "backref-shared", and the descriptions of the
+    data they refer to have the class "#<id>", like back references
+    to them, so that rules can match both.
+    """
+    def descr2(obj, recurse = None):
+        if isinstance(obj, Occurrence):
+            occurrence = obj
+            obj = obj.datum
+        else:
+            occurrence = Occurrence(obj)
+        recurse = recurse or descr2
+
+        def recurse2(x):
+            return recurse(Occurrence(x, occurrence))
+
+        if isinstance(obj, untracked_types):
+            return descr(obj, recurse2)
+
+        key = id(obj)
+        if shared:
+            if key in occurrence.seen:
+                if occurrence.in_cycle():
+                    return backref(obj, "cycle")
+                return backref(obj, "shared")
+            occurrence.seen.add(key)
+        elif occurrence.in_cycle():
+            return backref(obj, "cycle")
+
+        d = descr(obj, recurse2)
+        if not isinstance(d, str):
+            d = itertools.chain([{"#" + str(key)}], d)
+        return d
+
+    return descr2
+
+
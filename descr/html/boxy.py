@@ -169,6 +169,17 @@ html_boxy.layout = dict(
         (".{hl3}", {"font-weight": "bold"}),
         (".{hlE}", {"font-weight": "bold"}),
 
+        # What was left out because of a Budget, and back references
+        # (see track_references)
+        (".{elided}", {"white-space": "pre",
+                       "padding": "3px",
+                       "margin": "3px",
+                       "font-style": "italic"}),
+        (".{backref}", {"white-space": "pre",
+                        "padding": "3px",
+                        "margin": "3px",
+                        "font-style": "italic"}),
+
         (".{par}", {":wrap": lambda x: HTMLNode({}, [x], tag = p)}),
         (".{line}", {":after": lambda a, b: [[{"raw"}, "<br/>"]]}),
         (".{raw}", {":raw": True}),
@@ -189,6 +200,8 @@ html_boxy.styles["dark"] = dict(
         (".{@complex}", {"color": "#88f"}),
         (".{@str}", {"color": "#f88"}),
         (".{empty}", {"color": "#888"}),
+        (".{elided}", {"color": "#888"}),
+        (".{backref}", {"color": "#888"}),
 
         (".{sequence}", {"border": "2px solid #222"}),
         (".{empty}.{sequence}", {"border": "2px solid #000"}),
@@ -265,6 +278,8 @@ html_boxy.styles["light"] = dict(
         (".{@complex}", {"color": "#00a"}),
         (".{@str}", {"color": "#a00"}),
         (".{empty}", {"color": "#888"}),
+        (".{elided}", {"color": "#888"}),
+        (".{backref}", {"color": "#888"}),
 
         (".{sequence}", {"border": "2px solid #eee"}),
         (".{empty}.{sequence}", {"border": "2px solid #fff"}),
@@ -2,8 +2,9 @@
 import re
 
 from collections import OrderedDict
-from ..format import Formatter, exhaust_stream, RuleBuilder, DescriptionProcessor, descr
-from ..rules import RuleTree, RuleTreeExplorer, custom_merge
+from ..format import (Formatter, RuleBuilder, DescriptionProcessor,
+                      describe, Fragment, FragmentCache)
+from ..rules import RuleTree, custom_merge
 from ..util import Assoc, Group, Raw
 
 def generate_css(rules):
@@ -27,14 +28,49 @@ def escape_selector(selector):
     return re.sub("\\{([^}]*)\\}", escape, selector)
 
 
+# TODO: other characters
+_html_escapes = str.maketrans({"&": "&amp;",
+                               "<": "&lt;",
+                               ">": "&gt;",
+                               '"': "&quot;"})
+
+# These never contain characters that need to be escaped (subclasses
+# might, through __str__)
+_unescaped_types = (int, float, bool, type(None))
+
+# Escaped versions of the short strings seen so far. The same keys,
+# names and small numbers tend to come up over and over.
+_quoted = {}
+
 def quotehtml(x):
-    # TODO: other characters
-    s = str(x)
-    for orig, repl in [("&", "&amp;"),
-                       ("<", "&lt;"),
-                       (">", "&gt;"),
-                       ('"', "&quot;")]:
-        s = s.replace(orig, repl)
+    if not isinstance(x, str):
+        if type(x) in _unescaped_types:
+            return str(x)
+        x = str(x)
+    if len(x) > 64:
+        return x.translate(_html_escapes)
+    s = _quoted.get(x)
+    if s is None:
+        if len(_quoted) >= 10000:
+            _quoted.clear()
+        s = _quoted[x] = x.translate(_html_escapes)
+    return s
+
+
+# Opening tags for the class sets seen so far. The same class sets
+# come up over and over again, so this saves formatting them every
+# time. The key keeps the order in which the classes are iterated, so
+# the output is the same as without the cache.
+_open_tags = {}
+
+def open_tag(tag, classes):
+    key = (tag,) + tuple(classes)
+    s = _open_tags.get(key)
+    if s is None:
+        if len(_open_tags) >= 10000:
+            # Some classes, like #id, are specific to a node
+            _open_tags.clear()
+        s = _open_tags[key] = '<%s class="%s">' % (tag, " ".join(classes))
     return s
 
 
@@ -51,11 +87,53 @@ class HTMLNode(object):
                         self.tag)
 
     def __str__(self):
-        return '<%s class="%s">%s</%s>' % (
-            self.tag,
-            " ".join(self.classes),
-            "".join(map(str, self.children)),
-            self.tag)
+        buf = []
+        for _ in self.fill(buf):
+            pass
+        return "".join(buf)
+
+    def iter_html(self):
+        # Yields the HTML for this node in chunks.
+        buf = []
+        for _ in self.fill(buf):
+            yield "".join(buf)
+            del buf[:]
+        if buf:
+            yield "".join(buf)
+
+    def write_html(self, port):
+        for chunk in self.iter_html():
+            port.write(chunk)
+
+    def fill(self, buf, batch = 1000):
+        """
+        Appends the HTML for this node to the list buf. This is a
+        generator which yields every batch nodes or so, so that the
+        caller can flush buf.
+
+        Rather than recursing, we keep a stack of the nodes we are in
+        along with an iterator over their remaining children, so each
+        piece of the output is only copied once, when buf is joined.
+        """
+        append = buf.append
+        append(open_tag(self.tag, self.classes))
+        stack = [("</%s>" % self.tag, iter(self.children))]
+        n = 0
+        while stack:
+            for child in stack[-1][1]:
+                if isinstance(child, HTMLNode):
+                    append(open_tag(child.tag, child.classes))
+                    stack.append(("</%s>" % child.tag, iter(child.children)))
+                    n += 1
+                    if n >= batch:
+                        n = 0
+                        yield
+                    break
+                else:
+                    append(str(child))
+            else:
+                append(stack.pop()[0])
+        yield
 
     # white-space: pre fucks this up
     # def __str__(self, indent = 0):
@@ -93,44 +171,113 @@ class HTMLNode(object):
         return recurse(proxy)
 
 
-def generate_html(description, noinspect = False):
-    if description is None or isinstance(description, (int, float, bool)):
-        description = str(description)
+def generate_html(description, noinspect = False, fragments = None):
+    # This is done with an explicit stack rather than recursively, so
+    # that the depth of the description is only limited by memory.
+    # Each frame holds a node, whether inspection is blocked for its
+    # children, whether the node itself is inspected, the HTML for the
+    # children generated so far, an iterator over the remaining
+    # children and the list to put the node's HTML in. The HTML for
+    # nodes with a fragment_key is stored in fragments, if given.
+
+    stack = []
+
+    def enter(description, noinspect, out):
+        if description is None or isinstance(description, (str, int, float, bool)):
+            out.append(HTMLNode({}, [quotehtml(description)]))
+            return
+
+        if isinstance(description, Fragment):
+            out.append(description.value)
+            return
 
-    if isinstance(description, str):
-        node = HTMLNode({}, [quotehtml(description)])
-    else:
-        props = description.properties
         inspect_this = False
         if not noinspect:
             # We check if we will inspect this node, and if
             # it is so, we block the attribute in recursive
             # calls
-            for f in props.get(":inspect", ()):
+            for f in description.properties.get(":inspect", ()):
                 if f(description):
                     inspect_this = True
                     break
 
-        children = [generate_html(child, inspect_this or noinspect)
-                    for child in description.children]
-        classes = description.classes
-
-        for f in props.get(":htmlreplace", ()):
-            classes, children = f(classes, children)
-        for f in props.get(":join", ())[-1:]:
-            children = f(classes, children)
-        for f in props.get(":wrap", ()):
-            children = f(classes, children)
+        stack.append((description, inspect_this or noinspect, inspect_this,
+                      [], iter(description.children), out))
 
-        node = HTMLNode(classes, children)
+    rval = []
+    enter(description, noinspect, rval)
 
-        if inspect_this:
-            return generate_html(
-                description.process(descr(node), description.rules),
-                # No inspection here
-                True)
-
-    return node
+    while stack:
+        frame = stack[-1]
+        description, block, inspect_this, children, remaining, out = frame
+        for child in remaining:
+            enter(child, block, children)
+            if stack[-1] is not frame:
+                break
+        else:
+            stack.pop()
+            props = description.properties
+            classes = description.classes
+
+            for f in props.get(":htmlreplace", ()):
+                classes, children = f(classes, children)
+            for f in props.get(":join", ())[-1:]:
+                children = f(classes, children)
+            for f in props.get(":wrap", ()):
+                children = f(classes, children)
+
+            node = HTMLNode(classes, children)
+
+            if inspect_this:
+                enter(description.process(describe(node), description.rules),
+                      # No inspection here
+                      True, out)
+            else:
+                out.append(node)
+                key = description.fragment_key
+                if key is not None and fragments is not None \
+                        and not block and ":inspect" not in props:
+                    fragments.store(key, str(node))
+
+    return rval[0]
+
+
+# The properties with which generate_html needs all the children of a
+# node to be generated before the node itself
+_whole_properties = frozenset([":htmlreplace", ":join", ":wrap", ":inspect"])
+
+def stream_html(stream, rules, batch = 1000):
+    """
+    Yields the same HTML as generate_html(DescriptionProcessor.process(
+    stream, rules)), in chunks, but processes the description and
+    generates the HTML together, a node at a time, without building
+    either tree (see DescriptionProcessor.walk). The nodes that need
+    all of their children (:post, :htmlreplace, :join, :wrap,
+    :inspect) are processed and generated whole. A chunk is yielded
+    every batch nodes or so.
+    """
+    buf = []
+    append = buf.append
+    n = 0
+    for event, x in DescriptionProcessor.walk(stream, rules, _whole_properties):
+        if event == "enter":
+            append(open_tag("span", x.classes))
+        elif event == "exit":
+            append("</span>")
+            n += 1
+            if n >= batch:
+                n = 0
+                yield "".join(buf)
+                del buf[:]
+        elif event == "leaf":
+            append('<span class="">')
+            append(quotehtml(x))
+            append("</span>")
+        else:
+            for _ in generate_html(x).fill(buf):
+                pass
+    if buf:
+        yield "".join(buf)
 
 
 
@@ -138,7 +285,8 @@ class HTMLFormatter(Formatter):
 
     __n = 0
 
-    def __init__(self, rules, top = None, always_setup = False):
+    def __init__(self, rules, top = None, always_setup = False,
+                 fragment_cache = False, fused = False):
         self.id = HTMLFormatter.__n
         HTMLFormatter.__n += 1
         self._top = top
@@ -147,6 +295,13 @@ class HTMLFormatter(Formatter):
         else:
             self.top = top
         self.always_setup = always_setup
+        # See FragmentCache
+        self.fragments = FragmentCache() if fragment_cache else None
+        # If fused is True, descriptions are processed and translated
+        # to HTML in a single pass (see stream_html), which uses much
+        # less memory for large ones. The fragment cache is not used
+        # then.
+        self.fused = fused
 
         self._rules = rules
         self.cssrules = OrderedDict()
@@ -157,11 +312,33 @@ class HTMLFormatter(Formatter):
 
     __keep_top = object()
     def copy(self, top = __keep_top):
+        # The copy starts from the rules of this formatter without
+        # registering them again: its rule tree is an overlay of ours
+        # (see RuleTree.overlay), and only the keys of the CSS rules
+        # change if the top class does.
         if top is HTMLFormatter.__keep_top:
             top = self._top
-        return type(self)(self._rules, top)
+        new = type(self)(RuleBuilder(), top,
+                         fragment_cache = self.fragments is not None,
+                         fused = self.fused)
+        new._rules = self._rules
+        rename = None
+        if self.top and new.top != self.top:
+            rename = (self.top, new.top)
+        old_prefix = ".%s " % self.top
+        new_prefix = ".%s " % new.top
+        for selector, css in self.cssrules.items():
+            if rename and selector.startswith(old_prefix):
+                selector = new_prefix + selector[len(old_prefix):]
+            new.cssrules[selector] = dict(css)
+            if css:
+                new.css_rules_changed = True
+        new.rules = self.rules.overlay(rename)
+        return new
 
     def add_rules(self, ruleset):
+        if self.fragments is not None:
+            self.fragments.clear()
         for selector, props in ruleset.rules:
             raw_selector = escape_selector(selector)
             if self.top:
@@ -196,18 +373,44 @@ class HTMLFormatter(Formatter):
         else:
             return ""
 
-    def translate_no_setup(self, stream):
+    def generate(self, stream):
         if self.top:
             stream = ({self.top}, stream)
-        expl = RuleTreeExplorer({}, [(0, False, self.rules)])
-        html = generate_html(DescriptionProcessor.process(stream, expl))
-        return str(html)
+        expl = self.rules.matcher()
+        fragments = self.fragments
+        if fragments is not None:
+            fragments.check()
+        return generate_html(DescriptionProcessor.process(stream, expl, fragments),
+                             fragments = fragments)
+
+    def iter_html(self, stream):
+        # The HTML for stream, in chunks
+        if self.fused:
+            if self.top:
+                stream = ({self.top}, stream)
+            return stream_html(stream, self.rules.matcher())
+        return self.generate(stream).iter_html()
+
+    def translate_no_setup(self, stream):
+        if self.fused:
+            return "".join(self.iter_html(stream))
+        return str(self.generate(stream))
+
+    def translate_iter_no_setup(self, stream):
+        return self.iter_html(stream)
 
     def translate(self, stream):
         s = self.incremental_setup()
         s += self.translate_no_setup(stream)
         return s
 
+    def translate_iter(self, stream):
+        s = self.incremental_setup()
+        if s:
+            yield s
+        for chunk in self.translate_iter_no_setup(stream):
+            yield chunk
+
 
 
 class HTMLRuleBuilder(RuleBuilder):
@@ -18,8 +18,9 @@ except ImportError:
 
 class NotebookPrinter(Printer):
 
-    def __init__(self, descr, formatter):
-        super(NotebookPrinter, self).__init__(None, descr, formatter)
+    def __init__(self, descr, formatter, budget = None):
+        super(NotebookPrinter, self).__init__(None, descr, formatter,
+                                              budget = budget)
 
     def write(self, stream, rules = None):
         s = self.translate(stream, rules)
@@ -31,13 +32,19 @@ def boxy_notebook(descr = descr,
                   rules = None,
                   layout = None,
                   top = None,
-                  always_setup = False):
+                  always_setup = False,
+                  budget = None,
+                  fragment_cache = False,
+                  fused = False):
 
     if layout is None:
         layout = html_boxy["light"]
     if rules is not None:
         layout += rules
     pr = NotebookPrinter(descr, HTMLFormatter(layout, top = top,
-                                              always_setup = always_setup))
+                                              always_setup = always_setup,
+                                              fragment_cache = fragment_cache,
+                                              fused = fused),
+                         budget = budget)
     return pr
 
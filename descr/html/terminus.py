@@ -26,9 +26,18 @@ class TerminusFormatter(HTMLFormatter):
         return "".join(lines)
 
     def translate_no_setup(self, stream):
+        # The same as translate_iter_no_setup, in one piece
         s = super(TerminusFormatter, self).translate_no_setup(stream)
-        s = self.wrapesc(':h {x}'.format(x = s))
-        return s
+        return "\x1B[?0;7y:h {x}\a".format(x = s)
+
+    def translate_iter_no_setup(self, stream):
+        # We can't know in advance if there will be a newline in the
+        # html, so we always use the escape that can contain them
+        # (and so does translate_no_setup).
+        yield "\x1B[?0;7y:h "
+        for chunk in super(TerminusFormatter, self).translate_iter_no_setup(stream):
+            yield chunk
+        yield "\a"
 
 
 def boxy_terminus(out = sys.stdout,
@@ -36,7 +45,10 @@ def boxy_terminus(out = sys.stdout,
                   rules = None,
                   layout = None,
                   always_setup = False,
-                  top = None):
+                  top = None,
+                  budget = None,
+                  fragment_cache = False,
+                  fused = False):
 
     if layout is None:
         layout = html_boxy["dark"]
@@ -47,6 +59,9 @@ def boxy_terminus(out = sys.stdout,
                  descr,
                  TerminusFormatter(layout,
                                    top = top,
-                                   always_setup = always_setup))
+                                   always_setup = always_setup,
+                                   fragment_cache = fragment_cache,
+                                   fused = fused),
+                 budget = budget)
     return pr
 
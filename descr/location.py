@@ -1,5 +1,12 @@
 
+import os
+import mmap
+import codecs
+import linecache
+import heapq
+from array import array
 from bisect import bisect_right
+from collections import OrderedDict
 from functools import reduce
 from .highlight import highlight_lines
 
@@ -33,6 +40,207 @@ class Source(object):
         return self.linepos[line] + col
 
 
+class MappedSource(Source):
+    """
+    Source for a file, backed by mmap, for files that are too large to
+    be read in memory. The file is decoded with the given encoding,
+    and as for Source, positions and columns count characters, and
+    lines do not include the newline (nor a carriage return before
+    it).
+
+    Lines are only decoded when they are accessed. linepos is built
+    incrementally as positions and lines further in the file are
+    needed, along with the byte offsets of the lines, in compact
+    arrays. Asking for len(self.lines) indexes the whole file.
+    """
+
+    chunk_size = 1 << 20
+
+    def __init__(self, filename, encoding = "utf-8", url = None):
+        self.url = url or filename
+        self.encoding = encoding
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            else:
+                self.data = b""
+        self.size = len(self.data)
+        # Byte and character offsets of the start of each line. When
+        # the whole file is indexed, both have an extra entry one past
+        # the end of the last line, like Source.linepos.
+        self.bytepos = array("q", [0])
+        self.linepos = array("q", [0])
+        self.complete = False
+        self.lines = MappedLines(self)
+
+    def _content_end(self, start, end):
+        # end of the line [start, end), without the carriage return
+        if end > start and self.data[end - 1] == 13:
+            return end - 1
+        return end
+
+    def _decode(self, start, end):
+        return self.data[start:end].decode(self.encoding, "replace")
+
+    def _count_chars(self, start, end):
+        if end - start <= self.chunk_size:
+            return len(self._decode(start, end))
+        decoder = codecs.getincrementaldecoder(self.encoding)("replace")
+        n = 0
+        for i in range(start, end, self.chunk_size):
+            chunk = self.data[i:min(i + self.chunk_size, end)]
+            n += len(decoder.decode(chunk))
+        return n + len(decoder.decode(b"", True))
+
+    def _index_line(self):
+        # Indexes one more line. Returns False if there is none.
+        if self.complete:
+            return False
+        start = self.bytepos[-1]
+        end = self.data.find(b"\n", start)
+        if end < 0:
+            end = self.size
+            self.complete = True
+        n = self._count_chars(start, self._content_end(start, end))
+        self.bytepos.append(end + 1)
+        self.linepos.append(self.linepos[-1] + n + 1)
+        return True
+
+    def has_line(self, line):
+        # Indexes up to the given line (0-based) and returns whether it
+        # exists.
+        while len(self.bytepos) <= line + 1:
+            if not self._index_line():
+                return False
+        return True
+
+    def index_all(self):
+        while self._index_line():
+            pass
+
+    def line(self, line):
+        start = self.bytepos[line]
+        end = self._content_end(start, self.bytepos[line + 1] - 1)
+        return self._decode(start, end)
+
+    def linecol(self, pos):
+        while self.linepos[-1] <= pos and self._index_line():
+            pass
+        return super(MappedSource, self).linecol(pos)
+
+    def fromlinecol(self, line, col):
+        line -= 1
+        col -= 1
+        if line < 0 or not self.has_line(line):
+            raise IndexError(dict(line = line, col = col, source = self))
+        if col > len(self.line(line)):
+            raise IndexError(dict(line = line, col = col, source = self))
+        return self.linepos[line] + col
+
+
+class MappedLines(object):
+    # The lines of a MappedSource, as a sequence.
+
+    def __init__(self, source):
+        self.source = source
+
+    def __len__(self):
+        self.source.index_all()
+        return len(self.source.bytepos) - 1
+
+    def __getitem__(self, i):
+        source = self.source
+        if isinstance(i, slice):
+            if (i.start or 0) < 0 or i.stop is None or i.stop < 0:
+                source.index_all()
+            elif i.stop > 0:
+                source.has_line(i.stop - 1)
+            indices = range(*i.indices(len(source.bytepos) - 1))
+            return [source.line(j) for j in indices]
+        if i < 0:
+            i += len(self)
+        if i < 0 or not source.has_line(i):
+            raise IndexError(i)
+        return source.line(i)
+
+    def __iter__(self):
+        i = 0
+        while self.source.has_line(i):
+            yield self.source.line(i)
+            i += 1
+
+
+class SourceCache(object):
+    """
+    Cache of Source objects for files, so that each version of a file
+    is read and split into lines only once. An entry is valid as long
+    as the file's size and modification time do not change. At most
+    maxsize files are kept, the least recently used ones are dropped
+    first.
+
+    Files are read through linecache, so that they are shared with
+    the traceback module and friends. This also means that sources
+    linecache knows about but that are not on disk (e.g. code entered
+    in an interactive interpreter that registers it) can be shown.
+    """
+
+    def __init__(self, maxsize = 128, mmap_threshold = 1 << 24):
+        self.maxsize = maxsize
+        # Files larger than this are not read, but mapped with
+        # MappedSource
+        self.mmap_threshold = mmap_threshold
+        self.entries = OrderedDict()
+
+    def get(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return self.get_virtual(filename)
+
+        version = (st.st_size, st.st_mtime)
+        entry = self.entries.get(filename)
+        if entry is not None and entry[0] == version:
+            self.entries.move_to_end(filename)
+            return entry[1]
+
+        if self.mmap_threshold is not None and st.st_size > self.mmap_threshold:
+            source = MappedSource(filename)
+        else:
+            linecache.checkcache(filename)
+            lines = linecache.getlines(filename)
+            if lines or not st.st_size:
+                text = "".join(lines)
+            else:
+                # linecache could not decode the file
+                with open(filename) as f:
+                    text = f.read()
+            source = Source(text, filename)
+
+        self.entries[filename] = (version, source)
+        self.entries.move_to_end(filename)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+        return source
+
+    def get_virtual(self, filename):
+        entry = linecache.cache.get(filename)
+        if not entry or len(entry) < 3:
+            raise IOError("Could not read file: %s" % filename)
+        return Source("".join(entry[2]), filename)
+
+    def clear(self):
+        self.entries.clear()
+
+source_cache = SourceCache()
+
+def get_source(filename):
+    """
+    Returns a Source for the contents of the file, from source_cache.
+    Raises IOError if the file cannot be read.
+    """
+    return source_cache.get(filename)
+
+
 def linecolstr(start, end):
     (l1, c1), lc2 = start, end
     if lc2 is not None:
@@ -129,34 +337,65 @@ class Location(object):
 
 
 def descr_locations(specs, context = None):
+    """
+    Describes an excerpt of source code. specs is a list of (location,
+    classes) where location is a Location or a LocationSet (all in
+    the same source), and classes is added to the text they cover.
+
+    The excerpt shows the lines of each span, with context lines
+    around them. The windows of lines are merged when they overlap or
+    touch, and the source_gap "..." separates those that don't, so
+    scattered spans are shown in a single excerpt.
+    """
 
-    aggregate = merge_locations([l for l, _ in specs])
-    source = aggregate.source
+    source = specs[0][0].source
+    spans = []
+    refs = []
+    for loc, hl in specs:
+        # locations should be in the same source
+        assert loc.source is source
+        refs.append(({"source_loc"}, hl, loc.ref()))
+        if isinstance(loc, LocationSet):
+            spans.extend((l, hl) for l in loc)
+        else:
+            spans.append((loc, hl))
 
     header = [{"source_header"},
               ({"path", "+path", "field"}, source.url or "<string>")]
-    header += [({"source_loc"}, hl, l.ref()) for l, hl in specs]
+    header += refs
 
-    if context is None or context < 0:
+    if context is None or context < 0 or not spans:
         return [{"source_excerpt"}, header, []]
-    else:
-        locations = []
-        for loc, hl in specs:
-            locations.append((loc.start, loc.end, hl))
-
-    (l1, c1), end = aggregate.linecol()
-    (l2, c2) = end or (l1, c1)
-    l1 -= 1
-    l2 -= 1
-    c1 -= 1
-    c2 -= 1
-    l1 = max(l1 - context, 0)
-    l2 = min(l2 + context + 1, len(source.lines))
+
+    # Windows of lines (0-based, end exclusive) to show, with the
+    # spans in each.
+    windows = []
+    for loc, hl in sorted(spans, key = lambda spec: spec[0].start):
+        (l1, c1), end = loc.linecol()
+        (l2, c2) = end or (l1, c1)
+        l1 = max(l1 - 1 - context, 0)
+        l2 = l2 + context
+        if windows and l1 <= windows[-1][1]:
+            window = windows[-1]
+            window[1] = max(window[1], l2)
+        else:
+            window = [l1, l2, []]
+            windows.append(window)
+        window[2].append((loc.start, loc.end, hl))
+
+    excerpts = [(l1, source.lines[l1:l2], locations)
+                for l1, l2, locations in windows]
+    l1, lines, _ = excerpts[-1]
+    width = len(str(l1 + 1 + len(lines)))
 
     hl = [{"source_code"}]
-    hl += highlight_lines(source.lines[l1:l2],
-                          locations,
-                          l1 + 1, source.linepos[l1])
+    for i, (l1, lines, locations) in enumerate(excerpts):
+        if i > 0:
+            hl += ["\n", ({"source_gap"}, "..."), "\n"]
+        hl += highlight_lines(lines,
+                              locations,
+                              l1 + 1, source.linepos[l1],
+                              width = width)
 
     return [{"source_excerpt"}, header, hl]
 
@@ -169,9 +408,7 @@ def merge_locations(locations):
     version of the function might differentiate them, so *don't do
     it*)
 
-    TODO: it'd be nice to have a class for discontinuous locations, so
-    that you could highlight two tokens on the same line that are not
-    next to each other. Do it if a good use case arise.
+    To combine locations that are not contiguous, use LocationSet.
     """
     locations = list(sorted(loc for loc in locations))
     if not locations:
@@ -185,3 +422,100 @@ def merge_locations(locations):
                                     (list(l.tokens) for l in locations
                                      if l.tokens is not None), []))
 
+
+
+class LocationSet(object):
+    """
+    A set of spans in a source, which need not be contiguous. The
+    spans are kept sorted, and spans that overlap or touch are merged,
+    so a LocationSet is a set of positions (plus zero-width spans
+    where they do not touch another span). The starts and ends of the
+    spans are stored in two arrays.
+
+    Union (|) and intersection (&) take time proportional to the total
+    number of spans. Iterating over a LocationSet yields a Location
+    for each span.
+    """
+
+    def __init__(self, source, spans = ()):
+        self.source = source
+        self._set_sorted(sorted(spans))
+
+    def _set_sorted(self, spans):
+        starts = array("q")
+        ends = array("q")
+        for start, end in spans:
+            if ends and start <= ends[-1]:
+                if end > ends[-1]:
+                    ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_locations(cls, locations):
+        locations = list(locations)
+        if not locations:
+            raise Exception("You must give at least one location!")
+        source = locations[0].source
+        assert all(source is l.source for l in locations[1:])
+        return cls(source, (l.span for l in locations))
+
+    @classmethod
+    def _from_sorted(cls, source, spans):
+        rval = cls.__new__(cls)
+        rval.source = source
+        rval._set_sorted(spans)
+        return rval
+
+    def spans(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for span in self.spans():
+            yield Location(self.source, span)
+
+    def __contains__(self, pos):
+        i = bisect_right(self.starts, pos) - 1
+        return i >= 0 and pos < self.ends[i]
+
+    def _check(self, other):
+        if other.source is not self.source:
+            raise ValueError("LocationSets must be in the same source.")
+
+    def __or__(self, other):
+        self._check(other)
+        return LocationSet._from_sorted(
+            self.source, heapq.merge(self.spans(), other.spans()))
+
+    def __and__(self, other):
+        self._check(other)
+        starts1, ends1 = self.starts, self.ends
+        starts2, ends2 = other.starts, other.ends
+        spans = []
+        i = j = 0
+        while i < len(starts1) and j < len(starts2):
+            s1, e1, s2, e2 = starts1[i], ends1[i], starts2[j], ends2[j]
+            start = max(s1, s2)
+            end = min(e1, e2)
+            if start < end or start == end and (s1 == e1 or s2 == e2):
+                spans.append((start, end))
+            if e1 < e2:
+                i += 1
+            else:
+                j += 1
+        return LocationSet._from_sorted(self.source, spans)
+
+    def ref(self):
+        return ", ".join(l.ref() for l in self)
+
+    def __str__(self):
+        return self.ref()
+
+    def __repr__(self):
+        return "LocationSet(%s)" % self.ref()
@@ -1,32 +1,45 @@
 
 import traceback
+import itertools
+from .classes import class_set
 from types import FunctionType, MethodType, TracebackType
 NoneType = type(None)
 
 
 def classes(*classes):
-    classes = frozenset(classes)
+    classes = class_set(*classes)
     def f(datum, _):
         return (classes, str(datum))
     return f
 
 def str_with_classes(*classes):
-    classes = frozenset(classes)
+    classes = class_set(*classes)
     def f(datum, _):
         return (classes, str(datum))
     return f
 
 def str_with_classes_and_itself(*classes):
-    classes = frozenset(classes)
+    classes = class_set(*classes)
     def f(datum, _):
         s = str(datum)
-        return (classes, {"@"+s}, s)
+        return (classes, class_set("@"+s), s)
     return f
 
+def describe_elements(datum, recurse, f = None):
+    # tuple(map(f or recurse, datum)), but if recurse has a limit (see
+    # Budget), only the first limit elements are described, and
+    # recurse.elided(n) stands for the n others.
+    limit = getattr(recurse, "limit", None)
+    f = f or recurse
+    if limit is None or len(datum) <= limit:
+        return tuple(map(f, datum))
+    return (tuple(map(f, itertools.islice(datum, limit)))
+            + (recurse.elided(len(datum) - limit),))
+
 def iter_with_classes(*classes):
-    classes = frozenset(classes)
+    classes = class_set(*classes)
     def f(datum, recurse):
-        return (classes,) + tuple(map(recurse, datum))
+        return (classes,) + describe_elements(datum, recurse)
     return f
 
 
@@ -100,14 +113,104 @@ def format_traceback_from_exception(orig_exc, recurse):
     return elements
 
 
-types_registry = {
+_HEAPTYPE = 1 << 9
+
+_dict_classes = class_set("@dict", "sequence")
+_assoc_classes = class_set("assoc")
+
+def _descr_str(datum, recurse):
+    return str(datum)
+
+
+class TypesRegistry(dict):
+    """
+    Maps types to description functions f(datum, recurse). Lookups
+    through handler() are cached per type; the cache is cleared
+    whenever the registry is modified, and generation is incremented
+    so that other caches can tell.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TypesRegistry, self).__init__(*args, **kwargs)
+        self._static = {}
+        self._resolved = {}
+        self.generation = 0
+
+    def invalidate(self):
+        self._static.clear()
+        self._resolved.clear()
+        self.generation += 1
+
+    def handler(self, t):
+        # Builtin types cannot gain a __descr__ after the fact, so
+        # whatever we find for them can be cached outright. For other
+        # classes we still look up __descr__ every time (that lookup
+        # is cheap when it succeeds) and only cache the walk through
+        # the mro.
+        try:
+            return self._static[t]
+        except KeyError:
+            pass
+        static = not t.__flags__ & _HEAPTYPE
+        f = getattr(t, "__descr__", None)
+        if f is None:
+            try:
+                f = self._resolved[t]
+            except KeyError:
+                for t2 in t.__mro__:
+                    if t2 in self:
+                        f = self[t2]
+                        break
+                else:
+                    f = _descr_str
+                self._resolved[t] = f
+        if static:
+            self._static[t] = f
+        return f
+
+    def __setitem__(self, t, f):
+        super(TypesRegistry, self).__setitem__(t, f)
+        self.invalidate()
+
+    def __delitem__(self, t):
+        super(TypesRegistry, self).__delitem__(t)
+        self.invalidate()
+
+    def pop(self, *args):
+        self.invalidate()
+        return super(TypesRegistry, self).pop(*args)
+
+    def popitem(self):
+        self.invalidate()
+        return super(TypesRegistry, self).popitem()
+
+    def setdefault(self, t, f = None):
+        self.invalidate()
+        return super(TypesRegistry, self).setdefault(t, f)
+
+    def update(self, *args, **kwargs):
+        super(TypesRegistry, self).update(*args, **kwargs)
+        self.invalidate()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super(TypesRegistry, self).clear()
+        self.invalidate()
+
+
+types_registry = TypesRegistry({
     tuple: iter_with_classes("@tuple", "sequence"),
     list: iter_with_classes("@list", "sequence"),
     set: iter_with_classes("@set", "sequence"),
     frozenset: iter_with_classes("@set", "@frozenset", "sequence"),
-    dict: lambda d, recurse: ((frozenset({"@dict", "sequence"}),)
-                              + tuple(({"assoc"}, recurse(k), recurse(v))
-                                      for k, v in d.items())),
+    dict: lambda d, recurse: ((_dict_classes,)
+                              + describe_elements(
+                                  d.items(), recurse,
+                                  lambda kv: (_assoc_classes,
+                                              recurse(kv[0]), recurse(kv[1])))),
     bool: str_with_classes_and_itself("@bool", "scalar"),
     int: str_with_classes("@int", "scalar"),
     float: str_with_classes("@float", "scalar"),
@@ -117,4 +220,22 @@ types_registry = {
 
     Exception: format_traceback_from_exception,
     TracebackType: format_traceback,
-}
+})
+
+
+def register_descr(t, f = None):
+    """
+    Register f(datum, recurse) as the description function for
+    instances of t (and of its subclasses, unless they have a more
+    specific entry or a __descr__ method). Can be used as a decorator:
+
+    @register_descr(MyType)
+    def descr_mytype(datum, recurse): ...
+    """
+    if f is None:
+        return lambda f: register_descr(t, f)
+    types_registry[t] = f
+    return f
+
+def unregister_descr(t):
+    del types_registry[t]
@@ -3,6 +3,7 @@ import re
 import itertools
 from collections import defaultdict
 import cssselect as cs
+from .classes import intern_classes, ClassTable
 
 
 
@@ -46,12 +47,97 @@ class RuleTree(object):
 
     __id = 0
 
-    def __init__(self):
+    # Maximal number of transitions memoized by explorer()
+    cache_size = 10000
+
+    def __init__(self, owner = None):
         self.here = defaultdict(list)
-        self.immediate = defaultdict(RuleTree)
-        self.under = defaultdict(RuleTree)
+        self.immediate = {}
+        self.under = {}
         self.id = RuleTree.__id
         RuleTree.__id += 1
+        # Subtrees may be shared between the trees made by overlay().
+        # A root may only modify the subtrees with the same owner as
+        # itself, and copies the others when it needs to.
+        self.owner = owner if owner is not None else object()
+        self._explorer = None
+        self._compiled = None
+
+    def _copy(self, owner):
+        # Shallow copy with the same id, so the order of the rules
+        # (see accumulate_candidates) is unchanged.
+        new = RuleTree.__new__(RuleTree)
+        new.here = defaultdict(list, ((k, list(v)) for k, v in self.here.items()))
+        new.immediate = dict(self.immediate)
+        new.under = dict(self.under)
+        new.id = self.id
+        new.owner = owner
+        new._explorer = None
+        new._compiled = None
+        return new
+
+    def _child(self, catalog, key):
+        # The subtree at catalog[key], created or copied so that it is
+        # owned by self.owner. self must be owned by it too.
+        d = getattr(self, catalog)
+        tree = d.get(key)
+        if tree is None:
+            tree = d[key] = RuleTree(self.owner)
+        elif tree.owner is not self.owner:
+            tree = d[key] = tree._copy(self.owner)
+        return tree
+
+    def overlay(self, rename = None):
+        """
+        Returns a new RuleTree with the same rules as this one, which
+        more rules can be registered to without modifying this one,
+        and the other way around. The two trees share their subtrees
+        until they register rules under them (copy on write), so this
+        takes constant time. The rules registered to the new tree come
+        after these, as if they had been registered to this tree.
+
+        rename may be a pair (old, new) of class names, in which case
+        the rules on .old at the root of this tree are on .new in the
+        new tree (HTMLFormatter uses this to change the top class).
+        """
+        new = self._copy(object())
+        # Our subtrees are now shared, so we will have to copy them
+        # as well before modifying them
+        self.owner = object()
+        if rename is not None:
+            old, name = rename
+            for catalog in (new.immediate, new.under):
+                if old in catalog:
+                    catalog[name] = catalog.pop(old)
+        return new
+
+    def explorer(self):
+        # Returns the RuleTreeExplorer to start matching from. It is
+        # kept until rules are registered, so that the transitions it
+        # memoizes can be reused from one translation to the next.
+        if self._explorer is None:
+            cache = ExplorationCache(self.cache_size)
+            self._explorer = cache.explorer(frozenset(), ((0, False, self),))
+        return self._explorer
+
+    def compile(self):
+        # Returns a CompiledRuleTree for the current rules. It is kept
+        # until rules are registered.
+        if self._compiled is None:
+            self._compiled = CompiledRuleTree(self)
+        return self._compiled
+
+    def matcher(self):
+        # Returns the explorer the formatters should start from. The
+        # first use after the rules change goes through explorer(),
+        # which is cheaper to set up, but if the tree is used again
+        # without changes it is compiled.
+        if self._compiled is not None:
+            return self._compiled.explorer()
+        elif self._explorer is not None:
+            return self.compile().explorer()
+        else:
+            return self.explorer()
 
     def search(self, selector):
         return [self._search(selector, sel.parsed_tree)
@@ -73,11 +159,11 @@ class RuleTree(object):
 
         if isinstance(selector, cs.parser.Element):
             self.check_element(strselector, selector)
-            return self.under[True]
+            return self._child("under", True)
 
         elif isinstance(selector, cs.parser.Class):
             self.check_element(strselector, selector.selector)
-            return self.under[selector.class_name]
+            return self._child("under", selector.class_name)
 
         elif isinstance(selector, cs.parser.CombinedSelector):
             left = self._search(strselector, selector.selector)
@@ -95,9 +181,9 @@ class RuleTree(object):
                                  "selector_string": strselector})
 
             if combinator == ' ':
-                target = left.under[entry]
+                target = left._child("under", entry)
             elif combinator == '>':
-                target =  left.immediate[entry]
+                target = left._child("immediate", entry)
             else:
                 raise TypeError("Rules do not acknowledge the combinator '%s'" % combinator,
                                 {"selector": selector,
@@ -114,6 +200,8 @@ class RuleTree(object):
         targets = self.search(selector)
         for target in targets:
             custom_merge(target.here, properties, _merge_to_lists)
+        self._explorer = None
+        self._compiled = None
 
 
 def accumulate_candidates(classes, trees):
@@ -165,7 +253,125 @@ def accumulate_candidates(classes, trees):
 
     newtrees = list(newtrees)
     newtrees.sort(key = lambda x: (x[0], x[2].id))
-    return newtrees
+    return tuple(newtrees)
+
+
+def property_names(properties):
+    # The names of the properties that are set, which lets explore and
+    # DescriptionProcessor skip the steps that have nothing to do.
+    return frozenset(name for name, values in properties.items() if values)
+
+# Properties that make explore rewrite the classes or the children of a
+# node
+class_rewrite_properties = frozenset([":classes", ":-classes", ":+classes"])
+rewrite_properties = class_rewrite_properties | {":replace"}
+
+_class_rewrites = [(":classes", lambda x, y: y, False),
+                   (":-classes", lambda x, y: x - y, True),
+                   (":+classes", lambda x, y: x | y, True)]
+
+
+def pure(f, depends = "classes"):
+    """
+    Marks the rule function f as pure, so that its results may be
+    reused for other nodes and other translations, and returns f. If
+    depends is "classes", f(classes, children) must only depend on
+    classes. If it is "length", it may also depend on the number of
+    children, but not on the children themselves, which it is given
+    as they are (they may be Deferred objects). If it is "scalars",
+    it may depend on the children, and its results are only reused
+    for nodes whose children are all scalars (see scalar_key).
+    Results are shared between the nodes they are reused for, so they
+    must not be modified.
+    """
+    if depends not in _depends_rank:
+        raise ValueError("depends must be 'classes', 'length' or 'scalars'", depends)
+    try:
+        f.pure = depends
+    except AttributeError:
+        _pure_callables[f] = depends
+    return f
+
+
+# How much of a node each kind of pure function depends on
+_depends_rank = {"classes": 0, "length": 1, "scalars": 2}
+
+# What pure() marked callables that can't have attributes with, e.g.
+# bound methods (which are equal for the same function and object)
+# and builtins
+_pure_callables = {}
+
+def is_pure(f):
+    # "classes", "length", "scalars" or False (see pure). True is
+    # equivalent to "classes".
+    depends = getattr(f, "pure", False)
+    if not depends and _pure_callables:
+        try:
+            depends = _pure_callables.get(f, False)
+        except TypeError:
+            pass
+    if depends is True:
+        return "classes"
+    return depends
+
+
+def reads_children(f):
+    # Whether the rule function f may look at the children it is given
+    # (all but those marked pure on "classes" or "length")
+    return is_pure(f) not in ("classes", "length")
+
+
+_scalar_types = (str, int, float, bool, type(None))
+
+def scalar_key(children):
+    # Hashable key for children if they are all scalars (strings of at
+    # most 64 characters), else None. The types are part of the key
+    # since 1, 1.0 and True are equal.
+    key = []
+    for child in children:
+        t = type(child)
+        if t not in _scalar_types or (t is str and len(child) > 64):
+            return None
+        key.append((t, child))
+    return tuple(key)
+
+
+# Results of pure rule functions, by (function, classes), (function,
+# classes, len(children)) or (function, classes, scalar_key(children))
+# (see call_rule)
+_results = {}
+max_results = 10000
+
+def call_rule(f, classes, children):
+    """
+    Returns f(classes, children), reusing its result for the same
+    classes (and number of children, or scalar children) if f is
+    pure. classes should be
+    interned (see intern_classes); if they are not hashable, f is
+    simply called.
+    """
+    depends = is_pure(f)
+    if not depends:
+        return f(classes, children)
+    if depends == "classes":
+        key = (f, classes)
+    elif depends == "length":
+        key = (f, classes, len(children))
+    else:
+        ckey = scalar_key(children)
+        if ckey is None:
+            return f(classes, children)
+        key = (f, classes, ckey)
+    try:
+        return _results[key]
+    except KeyError:
+        pass
+    except TypeError:
+        return f(classes, children)
+    if len(_results) >= max_results:
+        _results.clear()
+    rval = _results[key] = f(classes, children)
+    return rval
 
 
 def consult(trees):
@@ -178,38 +384,362 @@ def consult(trees):
     return results
 
 
+class ExplorationCache(object):
+    """
+    Memo shared by the RuleTreeExplorers that descend from the same
+    root (see RuleTree.explorer). Explorers are interned by (classes,
+    candidates), the result of consult is kept per candidate list,
+    and transitions are kept per (parent explorer, classes). Class
+    sets are interned by RuleTreeExplorer.explore. Once more than
+    maxsize transitions are recorded, everything is dropped and the
+    cache starts over.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        self.explorers = {}
+        self.properties = {}
+        self.transitions = {}
+
+    def consult(self, candidates):
+        try:
+            return self.properties[candidates]
+        except KeyError:
+            props = self.properties[candidates] = consult(candidates)
+            return props
+
+    def explorer(self, classes, candidates):
+        key = (classes, candidates)
+        try:
+            return self.explorers[key]
+        except KeyError:
+            new = self.explorers[key] = RuleTreeExplorer(classes, candidates, self)
+            return new
+
+    def child(self, parent, classes):
+        key = (parent, classes)
+        try:
+            return self.transitions[key]
+        except KeyError:
+            pass
+        if len(self.transitions) >= self.maxsize:
+            self.clear()
+        new = self.explorer(classes,
+                            accumulate_candidates(classes, parent.candidates))
+        self.transitions[key] = new
+        return new
+
+
 class RuleTreeExplorer(object):
 
-    def __init__(self, classes, candidates):
+    # Maximal number of times the classes of a node may be rewritten
+    max_rewrites = 100
+    # Maximal number of class rewrites memoized per explorer
+    max_memo = 1000
+
+    def __init__(self, classes, candidates, cache = None):
         self.classes = classes
         self.candidates = candidates
-        self.properties = consult(candidates)
-
-    def explore(self, classes, children):
-        new = RuleTreeExplorer(classes, accumulate_candidates(classes, self.candidates))
-
-        for prop, combine, reiterate in [(":classes", lambda x, y: y, False),
-                                         (":-classes", lambda x, y: x - y, True),
-                                         (":+classes", lambda x, y: x | y, True)]:
-            functions = new.properties.get(prop, ())
-            if reiterate is False:
-                functions = functions[-1:]
-            for new_classes in functions:
-                if callable(new_classes):
-                    new_classes = new_classes(classes, children)
-                if isinstance(new_classes, str):
-                    new_classes = {new_classes}
-                if new_classes:
-                    new_classes = combine(classes, new_classes)
-                    if new_classes != classes:
-                        return self.explore(new_classes, children)
+        self.cache = cache
+        # (classes, explorer) rewrite_classes ended with, by classes
+        # and by (classes, len(children)) or (classes,
+        # scalar_key(children))
+        self.rewrites = {}
+        self.scalar_rewrites = {}
+        if cache is None:
+            self.properties = consult(candidates)
         else:
-
+            self.properties = cache.consult(candidates)
+        self.names = property_names(self.properties)
+
+    def child(self, classes):
+        # Explorer for a child node with the given classes. Siblings
+        # with identical classes get the same explorer when a cache is
+        # available.
+        if self.cache is None:
+            return RuleTreeExplorer(classes,
+                                    accumulate_candidates(classes, self.candidates))
+        else:
+            return self.cache.child(self, classes)
+
+    def rewrite_classes(self, classes, children, new = None, force = None):
+        """
+        Applies the :classes, :-classes and :+classes rules, starting
+        from new, the explorer for classes (self.child(classes) if not
+        given), until the classes no longer change. Returns the final
+        classes and their explorer. The functions that may read the
+        children are given force(children) instead, if force is given
+        (see explore).
+
+        The result is memoized when all the functions that were called
+        are pure (see pure): in self.rewrites by classes if they only
+        depend on the classes, in self.scalar_rewrites by classes and
+        len(children) if some also depend on the number of children,
+        or by classes and scalar_key(children) if some depend on
+        scalar children.
+        Rules that keep changing the classes raise a ValueError.
+        """
+        rewrites = self.rewrites
+        rval = rewrites.get(classes)
+        if rval is not None:
+            return rval
+        ckey = None
+        if self.scalar_rewrites:
+            rval = self.scalar_rewrites.get((classes, len(children)))
+            if rval is not None:
+                return rval
+            ckey = scalar_key(children)
+            if ckey is not None:
+                rval = self.scalar_rewrites.get((classes, ckey))
+                if rval is not None:
+                    return rval
+        start = classes
+        depends = "classes"
+        seen = []
+        if new is None:
+            new = self.child(classes)
+        while True:
+            if new.names.isdisjoint(class_rewrite_properties):
+                break
+            for prop, combine, reiterate in _class_rewrites:
+                functions = new.properties.get(prop, ())
+                if reiterate is False:
+                    functions = functions[-1:]
+                for new_classes in functions:
+                    if callable(new_classes):
+                        if force is not None and reads_children(new_classes):
+                            children = force(children)
+                            force = None
+                        if depends:
+                            d = is_pure(new_classes)
+                            if not d or _depends_rank[d] > _depends_rank[depends]:
+                                depends = d
+                        new_classes = new_classes(classes, children)
+                    if isinstance(new_classes, str):
+                        new_classes = {new_classes}
+                    if new_classes:
+                        new_classes = combine(classes, new_classes)
+                        if new_classes != classes:
+                            break
+                else:
+                    continue
+                break
+            else:
+                break
+            seen.append(classes)
+            classes = intern_classes(new_classes)
+            if classes in seen or len(seen) >= self.max_rewrites:
+                raise ValueError("The rules for these classes keep rewriting them",
+                                 {"classes": seen + [classes]})
+            new = self.child(classes)
+        if depends == "length":
+            start = (start, len(children))
+            rewrites = self.scalar_rewrites
+        elif depends == "scalars":
+            if ckey is None:
+                ckey = scalar_key(children)
+            if ckey is None:
+                return classes, new
+            start = (start, ckey)
+            rewrites = self.scalar_rewrites
+        elif not depends:
+            return classes, new
+        if len(rewrites) >= self.max_memo:
+            rewrites.clear()
+        rewrites[start] = (classes, new)
+        return classes, new
+
+    def explore(self, classes, children, force = None):
+        # Returns the explorer for a node with the given classes and
+        # children, and its children, after the rules that rewrite them.
+        # If force is given, the rule functions that may read the
+        # children are given force(children) instead, e.g. so that
+        # they see descriptions rather than Deferred objects, while
+        # the children that are returned are left as they are unless
+        # :replace replaces them.
+        classes = intern_classes(classes)
+        new = self.child(classes)
+
+        if new.names.isdisjoint(rewrite_properties):
+            return new, children
+
+        for i in range(self.max_rewrites):
+            classes, new = self.rewrite_classes(classes, children, new, force)
             for f in new.properties.get(":replace", ()):
-                new_classes, new_children = f(classes, children)
+                args = children
+                if force is not None and reads_children(f):
+                    args = force(children)
+                new_classes, new_children = call_rule(f, classes, args)
+                children = new_children
                 if new_classes != classes:
-                    return self.explore(new_classes, new_children)
-                else:
-                    children = new_children
+                    classes = intern_classes(new_classes)
+                    new = None
+                    break
             else:
                 return new, children
+
+        raise ValueError("The :replace rules for these classes keep rewriting them",
+                         {"classes": classes})
+
+
+class CompiledRuleTree(object):
+    """
+    Frozen state machine equivalent to a RuleTree. Every subtree of
+    the RuleTree is numbered in (depth, id) order, which is the order
+    accumulate_candidates sorts candidates in, so that a candidate
+    (depth, hasit, subtree) can be represented as the bit number
+    2 * index + hasit of an integer mask. A candidate list is then a
+    mask and the candidates for a child are obtained by or-ing
+    together what each candidate contributes for the child's classes.
+
+    The class names that appear in the rules are numbered as well
+    (see ClassTable), so the classes of a node are matched as a
+    bitset, and names no rule mentions are dropped once and for all.
+
+    States (RuleState) are numbered in the order their mask is first
+    reached. Each state has its properties merged and its transitions
+    per class precomputed.
+    """
+
+    # Maximal number of successors/explorers memoized per state
+    state_cache_size = 1000
+
+    def __init__(self, tree):
+        trees = []
+        names = set()
+        stack = [(0, tree)]
+        while stack:
+            depth, t = stack.pop()
+            trees.append((depth, t.id, t))
+            for catalog in (t.immediate, t.under):
+                for klass, subtree in catalog.items():
+                    if klass is not True:
+                        names.add(klass)
+                    stack.append((depth + 1, subtree))
+        trees.sort(key = lambda x: x[:2])
+        self.trees = [t for _, _, t in trees]
+        index = {t: i for i, t in enumerate(self.trees)}
+        self.class_table = ClassTable(sorted(names), frozen = True)
+        ids = self.class_table.ids
+
+        # contributions[bit] = (mask, {class_id: mask}) where the
+        # first mask is what the candidate contributes regardless of
+        # the classes of the child (rules on "*" and the candidate
+        # itself, if it must keep looking)
+        self.contributions = []
+        for t in self.trees:
+            for hadit in (False, True):
+                base = 0
+                transitions = defaultdict(int)
+                catalogs = [t.under]
+                if hadit:
+                    catalogs.append(t.immediate)
+                for catalog in catalogs:
+                    for klass, subtree in catalog.items():
+                        b = 1 << (2 * index[subtree] + 1)
+                        if klass is True:
+                            base |= b
+                        else:
+                            transitions[ids[klass]] |= b
+                if t.under:
+                    base |= 1 << (2 * index[t])
+                self.contributions.append((base, dict(transitions)))
+
+        self.states = []
+        self.masks = {}
+        self.root = self.state(1 << (2 * index[tree]))
+
+    def state(self, mask):
+        try:
+            return self.masks[mask]
+        except KeyError:
+            state = RuleState(self, mask, len(self.states))
+            self.states.append(state)
+            self.masks[mask] = state
+            return state
+
+    def explorer(self):
+        return CompiledExplorer(frozenset(), self.root)
+
+
+class RuleState(object):
+
+    def __init__(self, machine, mask, id):
+        self.machine = machine
+        self.mask = mask
+        self.id = id
+        properties = defaultdict(list)
+        base = 0
+        transitions = defaultdict(int)
+        # Bits are visited in increasing order, which is the order in
+        # which consult would merge the candidates.
+        while mask:
+            low = mask & -mask
+            mask ^= low
+            b = low.bit_length() - 1
+            i, hasit = divmod(b, 2)
+            if hasit:
+                custom_merge(properties, machine.trees[i].here, _merge_lists)
+            cbase, ctransitions = machine.contributions[b]
+            base |= cbase
+            for klass, m in ctransitions.items():
+                transitions[klass] |= m
+        self.properties = properties
+        self.names = property_names(properties)
+        self.base = base
+        self.transitions = dict(transitions)
+        # Bitset of the classes that lead somewhere from this state
+        self.relevant = sum(1 << klass for klass in self.transitions)
+        # Successor states by bitset of relevant classes
+        self.successors = {}
+        # CompiledExplorers by (interned) class set
+        self.explorers = {}
+        # See RuleTreeExplorer.rewrite_classes
+        self.rewrites = {}
+        self.scalar_rewrites = {}
+
+    def next(self, classes):
+        bits = self.machine.class_table.bitset(classes) & self.relevant
+        try:
+            return self.successors[bits]
+        except KeyError:
+            pass
+        mask = self.base
+        transitions = self.transitions
+        b = bits
+        while b:
+            low = b & -b
+            b ^= low
+            mask |= transitions[low.bit_length() - 1]
+        if len(self.successors) >= self.machine.state_cache_size:
+            self.successors.clear()
+        state = self.successors[bits] = self.machine.state(mask)
+        return state
+
+
+class CompiledExplorer(RuleTreeExplorer):
+
+    def __init__(self, classes, state):
+        self.classes = classes
+        self.state = state
+        self.properties = state.properties
+        self.names = state.names
+        # Shared by all the explorers in the same state, since the
+        # rules that apply only depend on the state
+        self.rewrites = state.rewrites
+        self.scalar_rewrites = state.scalar_rewrites
+
+    def child(self, classes):
+        explorers = self.state.explorers
+        try:
+            return explorers[classes]
+        except KeyError:
+            pass
+        if len(explorers) >= self.state.machine.state_cache_size:
+            explorers.clear()
+        new = explorers[classes] = CompiledExplorer(classes,
+                                                    self.state.next(classes))
+        return new
@@ -1,6 +1,7 @@
 
 from . import location
 from .format import RuleBuilder, exhaust_stream
+from .rules import pure
 from .highlight import highlight_lines
 
 
@@ -25,6 +26,12 @@ def _check_empty_sequence(classes, parts):
     else:
         return {"empty"}
 
+# Their results can be reused for nodes with the same classes and
+# scalar children, or the same number of children for sequences, which
+# are then not described just for this (see rules.pure)
+pure(_check_empty_str, "scalars")
+pure(_check_empty_sequence, "length")
+
 
 # Functions to reorganize nodes with specific classes.
 
@@ -55,6 +62,8 @@ def _pull_field(classes, parts):
             [({"fieldlabel"}, field),
              ({"field", pfield} | classes2,) + tuple(parts)])
 
+pure(_pull_field, "scalars")
+
 
 def _replace_object(classes, parts, fieldlist = True):
     # Transform a node with the "object" class so that its label,
@@ -138,12 +147,11 @@ def _extract_locations(classes, parts):
     if "file" in cls:
         if len(args) > 1:
             filename, text = args
+            source = location.Source(text, filename)
         else:
             filename = args[0]
             try:
-                f = open(filename)
-                text = f.read()
-                f.close()
+                source = location.get_source(filename)
             except IOError:
                 return (classes,
                         [[{'source_header'},
@@ -151,10 +159,7 @@ def _extract_locations(classes, parts):
                           ({'source_loc'}, {'hl1'}, "???")],
                          [{'source_code'}, "Could not read file."]])
     else:
-        text = arg
-        filename = "<string>"
-
-    source = location.Source(text, filename)
+        source = location.Source(args[0], "<string>")
 
     locs = []
 
@@ -197,6 +202,8 @@ def _insert_lineno(c, d):
             width = max(width, int(cls[2:]))
     return [n.rjust(width)]
 
+pure(_insert_lineno, "classes")
+
 
 basic = RuleBuilder(
 
@@ -1,8 +1,9 @@
 
-import sys, re
-from ..rules import escape_selector, RuleTree, RuleTreeExplorer
-from ..format import RuleBuilder, Formatter, descr, Printer, DescriptionProcessor
-from ..html import make_joiner
+import sys, re, shutil
+from types import GeneratorType
+from ..rules import escape_selector, RuleTree
+from ..format import (RuleBuilder, Formatter, descr, Printer, DescriptionProcessor,
+                      Fragment, FragmentCache)
 
 
 textprops = dict(
@@ -40,17 +41,18 @@ def extract_textprops(props):
 
 sgr = re.compile("(\x1b[^a-zA-Z]*m)")
 sgr_end = "\x1b[0m"
+
 def fix_sgr_nesting(s):
     # Control codes in a terminal do not nest. For instance, you can't
     # set the text color to red, then to blue, then pop blue off to
     # get back to red. This function tracks the various changes in
     # text properties and restores them every time they are "popped
-    # off".
+    # off". The formatter does not need it anymore, since LineWriter
+    # keeps track of the text properties itself.
     stack = []
     strings = []
-    sgrs = list(sgr.finditer(s))
     i = 0
-    for m in sgrs:
+    for m in sgr.finditer(s):
         it = m.groups()[0]
         start, end = m.span()
         strings.append(s[i:start])
@@ -66,20 +68,269 @@ def fix_sgr_nesting(s):
     return "".join(strings)
 
 
+def sgr_transition(active, wanted):
+    # Control codes to go from the text properties in active to those
+    # in wanted. Properties can be added to the current ones, but the
+    # only way to remove some is to reset everything.
+    n = len(active)
+    if wanted[:n] == active:
+        return "\x1B[%sm" % ";".join(map(str, wanted[n:]))
+    elif wanted:
+        return "\x1B[0m\x1B[%sm" % ";".join(map(str, wanted))
+    else:
+        return sgr_end
+
+
 # def get_widths(node):
 #     if isinstance(node, str):
 #         return [len(node)]
 #     return node.widths()
 
-def convert(node):
+default_width = 80
+
+def convert(node, width = default_width):
     if isinstance(node, str):
         return [node]
-    return node.convert()
+    return node.convert(width)
+
+def iter_convert(node, width = default_width):
+    # Like convert, but yields each line as soon as it is complete.
+    if isinstance(node, str):
+        return iter([node])
+    return node.iter_convert(width)
+
+
+def flat_width(items, limit):
+    """
+    Width of items (strings and TextNodes) if they are all written on
+    a single line, or None if that is more than limit, or if they
+    cannot be written on a single line at all. Nodes are measured with
+    the flat() method of their layout and, since measuring stops as
+    soon as limit is exceeded, this never looks at much more than
+    limit characters.
+    """
+    width = 0
+    stack = [iter(items)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, str):
+                if "\n" in item:
+                    return None
+                width += len(item)
+                if width > limit:
+                    return None
+            else:
+                layout = getattr(item, "layout", None)
+                flat = getattr(layout, "flat", None)
+                items = flat and flat(item.children)
+                if items is None:
+                    return None
+                stack.append(iter(items))
+                break
+        else:
+            stack.pop()
+    return width
+
+
+
+class LineWriter(object):
+    """
+    Accumulates the output of TextNodes and layouts, line by line.
+
+    Nodes write to the current line and call newline() to start a new
+    one, which begins with indent spaces. The current line is kept as
+    a list of strings and its indent as a number, and they are only
+    joined when the line is complete. A node may produce no lines
+    at all (e.g. Lines(trail = False) with no children), in which case
+    whatever its parent meant to put before its first line (a line
+    break, some indentation, a control code) must not be output. So
+    these go in the pending list and are only output by begin(), which
+    every node calls before writing its first line. Pending line
+    breaks are represented by the indent of the new line, text
+    properties to push by a tuple, other entries are strings.
+
+    The text properties of the nodes being written are kept on a
+    stack. Control codes are not output when a node starts or ends,
+    but right before the next visible text, and only to go from the
+    properties currently in effect to the ones on top of the stack.
+    So siblings with the same properties share them, and col only
+    counts visible characters.
+    """
+
+    def __init__(self, width = default_width):
+        self.lines = []
+        self.current = []
+        self.current_indent = 0
+        self.col = 0
+        self.lineno = 0
+        self.indent = 0
+        self.pending = []
+        # Incremented by begin(), so that a node can tell whether it
+        # produced any lines.
+        self.mark = 0
+        # Text properties wanted by the nodes being written (each
+        # entry includes those of the entries below it), and those in
+        # effect in the output. The latter is None after a string
+        # which contains its own control codes.
+        self.styles = [()]
+        self.style = ()
+        # Used by Group: the width of the output, whether we are in a
+        # group which is written on a single line, and how much text
+        # the enclosing group will put after the current node before
+        # its next line break.
+        self.width = width
+        self.flat = False
+        self.trail = 0
+
+    def begin(self):
+        self.mark += 1
+        if self.pending:
+            pending = self.pending
+            self.pending = []
+            for entry in pending:
+                if isinstance(entry, int):
+                    self.newline(entry)
+                elif isinstance(entry, tuple):
+                    self.push_style(entry)
+                else:
+                    self.append(entry)
+
+    def push_style(self, textprops):
+        style = self.styles[-1]
+        if style[len(style) - len(textprops):] != textprops:
+            style = style + textprops
+        self.styles.append(style)
+
+    def pop_style(self):
+        self.styles.pop()
+
+    def sync_style(self):
+        wanted = self.styles[-1]
+        if self.style is None:
+            self.current.append(sgr_transition((None,), wanted))
+        else:
+            self.current.append(sgr_transition(self.style, wanted))
+        self.style = wanted
+
+    def append(self, s):
+        if s:
+            if self.style != self.styles[-1]:
+                self.sync_style()
+            self.current.append(s)
+            self.col += len(s)
+            if "\x1B" in s:
+                self.style = None
+
+    def write(self, s):
+        self.begin()
+        self.append(s)
+
+    def newline(self, indent = None):
+        if indent is None:
+            indent = self.indent
+        if self.style != self.styles[-1]:
+            # So that the line break and the indentation have the
+            # right properties
+            self.sync_style()
+        self.lines.append(self.current_line())
+        self.current = []
+        self.current_indent = indent
+        self.col = indent
+        self.lineno += 1
+
+    def current_line(self):
+        return " " * self.current_indent + "".join(self.current)
+
+    def write_lines(self, lines):
+        if lines:
+            self.write(lines[0])
+            for line in lines[1:]:
+                self.newline()
+                self.append(line)
+
+    def local_column(self, start, lineno, indent):
+        # Column relative to where a node started writing: on its first
+        # line, this is the start column, on the others, the indent its
+        # parent gave it.
+        return self.col - (start if self.lineno == lineno else indent)
+
+
+def write_text(render, width = default_width):
+    """
+    Runs render(out), where out is a LineWriter for the given width,
+    and yields the lines it produces as soon as they are complete.
+
+    render should return a generator which yields the children to
+    write: strings are written as they are, TextNodes are rendered in
+    turn, and so are generators. Nested generators are kept on a
+    stack, so there is no recursion.
+    """
+    out = LineWriter(width)
+    stack = [render(out)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, GeneratorType):
+                stack.append(item)
+                break
+            elif hasattr(item, "render"):
+                stack.append(item.render(out))
+                break
+            elif isinstance(item, str):
+                out.write(item)
+            else:
+                out.write_lines(item.convert())
+            if out.lines:
+                for line in out.lines:
+                    yield line
+                del out.lines[:]
+        else:
+            stack.pop()
+        if out.lines:
+            for line in out.lines:
+                yield line
+            del out.lines[:]
+    if out.mark:
+        if out.style != ():
+            out.current.append(sgr_end)
+        yield out.current_line()
+
+
+def consume(children):
+    # Iterates over children. If they are streamed, each child is
+    # dropped as soon as the next one is taken, so it can't be looked
+    # at again (see _StreamedChildren.consume).
+    if isinstance(children, _StreamedChildren):
+        return children.consume()
+    return iter(children)
+
 
+class TextLayout(object):
+    # Layouts implement render(children, out), a generator which
+    # writes to out (a LineWriter) and yields the children in the
+    # order they should be written (see write_text).
 
+    # They may also implement flat(children), which returns the
+    # strings and children they would write if the whole node fits on
+    # a single line, in order, or None if it never does (see
+    # flat_width).
 
+    # children is a list, or a _StreamedChildren when the output is
+    # streamed, which supports len(), indexing and iteration. Layouts
+    # that write their children once, in order, should go through
+    # them with consume(), so that those can be dropped as they go.
 
-class Join(object):
+    def convert(self, children, width = default_width):
+        return list(self.iter_convert(children, width))
+
+    def iter_convert(self, children, width = default_width):
+        return write_text(lambda out: self.render(children, out), width)
+
+    def flat(self, children):
+        return None
+
+
+
+class Join(TextLayout):
 
     def __init__(self, begin, join, end, indent = True):
         self.begin = begin.split("\n")
@@ -104,28 +355,99 @@ class Join(object):
     #         widths += new_widths[1:]
     #     return widths
 
-    def convert(self, children):
+    def flat(self, children):
+        if len(self.begin) > 1 or len(self.end) > 1 \
+                or (len(children) > 1 and len(self.join) > 1):
+            return None
+        return self.flat_items(children or [""])
+
+    def flat_items(self, children):
+        # A generator, so that only the children flat_width gets to
+        # are looked at
+        join = ""
+        yield self.begin[0]
+        for child in children:
+            yield join
+            yield child
+            join = self.join[0]
+        yield self.end[0]
+
+    def render(self, children, out):
         children = children or [""]
-        groups = [(True, self.begin)]
-        for child in children[:-1]:
-            groups.append((False, convert(child)))
-            groups.append((True, self.join))
-        groups.append((False, convert(children[-1])))
-        groups.append((True, self.end))
+        out.begin()
+        start, lineno, base, trail = out.col, out.lineno, out.indent, out.trail
         indent = 0
-        lines = [""]
-        for special, new_lines in groups:
-            if special:
-                indent = 0
-            lines[-1] += new_lines[0]
-            lines.extend(" " * indent + line for line in new_lines[1:])
+        group = self.begin
+        remaining = consume(children)
+        i = 0
+        while True:
+            out.append(group[0])
+            for line in group[1:]:
+                out.newline()
+                out.append(line)
             if self.indent:
-                indent = len(lines[-1])
-        return lines
-
+                indent = out.local_column(start, lineno, base)
+            if i == len(children):
+                break
+            # Whether the child is the last one is only checked once
+            # we have it (see _StreamedChildren)
+            child = next(remaining)
+            i += 1
+            last = i == len(children)
+            group = self.end if last else self.join
+            out.trail = len(group[0])
+            if last and len(group) == 1:
+                out.trail += trail
+            out.indent = base + indent
+            yield child
+            out.indent = base
+            if self.indent:
+                indent = out.local_column(start, lineno, base)
+        out.trail = trail
+
+
+
+class Group(Join):
+    """
+    Like Join, but if the whole node fits in the width of the output,
+    it is written on a single line with flat_begin, flat_join and
+    flat_end instead of begin, join and end, and so is every group
+    inside it. Otherwise it is broken like Join would, and each child
+    decides for itself.
+
+    Whether the node fits is decided before writing it, from its flat
+    width (see flat_width) and the text its parent will put after it
+    on the same line, so nothing is rendered twice. The width of the
+    output can be overriden with width.
+    """
+
+    def __init__(self, begin, join, end, flat_begin, flat_join, flat_end,
+                 indent = True, width = None):
+        Join.__init__(self, begin, join, end, indent)
+        self.flat_layout = Join(flat_begin, flat_join, flat_end, False)
+        self.width = width
+
+    def flat(self, children):
+        return self.flat_layout.flat(children)
+
+    def render(self, children, out):
+        out.begin()
+        if out.flat:
+            fits = True
+        else:
+            width = out.width if self.width is None else self.width
+            limit = width - out.col - out.trail
+            fits = flat_width(self.flat(children), limit) is not None
+        if fits:
+            flat = out.flat
+            out.flat = True
+            yield self.flat_layout.render(children, out)
+            out.flat = flat
+        else:
+            yield Join.render(self, children, out)
 
 
-class Concat(object):
+class Concat(TextLayout):
 
     # def widths(self, children):
     #     widths = [0]
@@ -135,16 +457,16 @@ class Concat(object):
     #         widths += new_widths[1:]
     #     return widths
 
-    def convert(self, children):
-        lines = [""]
-        for child in children:
-            cvt = convert(child)
-            lines[-1] += cvt[0]
-            lines.extend(cvt[1:])
-        return lines
+    def flat(self, children):
+        return children
 
+    def render(self, children, out):
+        out.begin()
+        for child in consume(children):
+            yield child
 
-class ConcatIndent(object):
+
+class ConcatIndent(TextLayout):
 
     # def widths(self, children):
     #     widths = [0]
@@ -156,17 +478,20 @@ class ConcatIndent(object):
     #         indent = widths[-1]
     #     return widths
 
-    def convert(self, children):
+    def flat(self, children):
+        return children
+
+    def render(self, children, out):
+        out.begin()
+        start, lineno, base = out.col, out.lineno, out.indent
         indent = 0
-        lines = [""]
-        for child in children:
-            cvt = convert(child)
-            lines[-1] += cvt[0]
-            lines.extend(" " * indent + line for line in cvt[1:])
-            indent = len(lines[-1])
-        return lines
+        for child in consume(children):
+            out.indent = base + indent
+            yield child
+            out.indent = base
+            indent = out.local_column(start, lineno, base)
 
-class Lines(object):
+class Lines(TextLayout):
 
     def __init__(self, trail = True):
         self.trail = trail
@@ -177,15 +502,28 @@ class Lines(object):
     #         rval.append(0)
     #     return rval
 
-    def convert(self, children):
-        rval = sum(map(convert, children), [])
-        if self.trail:
-            rval.append("")
-        return rval
+    def flat(self, children):
+        if self.trail or len(children) > 1:
+            return None
+        return children
+
+    def render(self, children, out):
+        mark = out.mark
+        for child in consume(children):
+            if out.mark != mark:
+                # Line break before the child, if it has any lines
+                out.pending[:] = [out.indent]
+            yield child
+        if out.mark != mark:
+            del out.pending[:]
+            if self.trail:
+                out.newline()
+        elif self.trail:
+            out.write("")
 
 
 
-class Indented(object):
+class Indented(TextLayout):
 
     def __init__(self, start = 0, middle = 2, end = None):
         self.start = start
@@ -204,17 +542,34 @@ class Indented(object):
     #         widths += [w + self.end for w in get_widths(child)]
     #     return widths
 
-    def convert(self, children):
-        lines = []
-        for child in children[:1]:
-            lines += [" " * self.start + line for line in convert(child)]
-        if len(children) == 1:
-            return lines
-        for child in children[1:-1]:
-            lines += [" " * self.middle + line for line in convert(child)]
-        for child in children[-1:]:
-            lines += [" " * self.end + line for line in convert(child)]
-        return lines
+    def flat(self, children):
+        if len(children) > 1:
+            return None
+        return children and [" " * self.start] + list(children)
+
+    def render(self, children, out):
+        mark = out.mark
+        base = out.indent
+        first = len(out.pending)
+        for i, child in enumerate(consume(children)):
+            if i == 0:
+                indent = self.start
+            elif i == len(children) - 1:
+                indent = self.end
+            else:
+                indent = self.middle
+            out.indent = base + indent
+            if out.mark != mark:
+                out.pending[:] = [out.indent]
+            else:
+                del out.pending[first:]
+                out.pending.append(" " * indent)
+            yield child
+        out.indent = base
+        if out.mark != mark:
+            del out.pending[:]
+        else:
+            del out.pending[first:]
 
         
 
@@ -256,14 +611,28 @@ class TextNode(object):
     def widths(self):
         return self.layout.widths(self.children)
 
-    def convert(self):
-        lines = self.layout.convert(self.children)
+    def convert(self, width = default_width):
+        return list(self.iter_convert(width))
+
+    def iter_convert(self, width = default_width):
+        return write_text(self.render, width)
+
+    def render(self, out):
+        # The text properties are pushed before the first line and
+        # popped after the last, if there are any lines.
         textprops = extract_textprops(self.properties)
+        first = len(out.pending)
         if textprops:
-            prelude = "\x1B[%sm" % ";".join(map(str, textprops))
-            lines[0] = prelude + lines[0]
-            lines[-1] += "\x1B[0m"
-        return lines
+            out.pending.append(tuple(textprops))
+        mark = out.mark
+        if hasattr(self.layout, "render"):
+            yield self.layout.render(self.children, out)
+        else:
+            out.write_lines(self.layout.convert(list(self.children)))
+        if out.mark == mark:
+            del out.pending[first:]
+        elif textprops:
+            out.pop_style()
 
     def __len__(self):
         return self.length
@@ -278,50 +647,209 @@ class TextNode(object):
 
 
 
-def generate_text(description):
-    if description is None or isinstance(description, (int, float, bool)):
-        description = str(description)
+def generate_text(description, fragments = None):
+    # Uses an explicit stack, for the same reason as generate_html.
+    # Each frame holds a node, the text nodes for the children
+    # generated so far, an iterator over the remaining children and
+    # the list to put the node's text node in. The text nodes for
+    # nodes with a fragment_key are stored in fragments, if given.
 
-    if isinstance(description, str):
-        node = description
-    else:
-        props = description.properties
+    stack = []
 
-        children = [generate_text(child)
-                    for child in description.children]
+    def enter(description, out):
+        if description is None or isinstance(description, (int, float, bool)):
+            description = str(description)
+
+        if isinstance(description, str):
+            out.append(description)
+        elif isinstance(description, Fragment):
+            out.append(description.value)
+        else:
+            stack.append((description, [], iter(description.children), out))
+
+    rval = []
+    enter(description, rval)
+
+    while stack:
+        frame = stack[-1]
+        description, children, remaining, out = frame
+        for child in remaining:
+            enter(child, children)
+            if stack[-1] is not frame:
+                break
+        else:
+            stack.pop()
+            props = description.properties
 
-        for f in props.get(":textreplace", ()):
-            props, children = f(props, children)
-        for f in props.get(":join", ())[-1:]:
-            children = f(props, children)
-        for f in props.get(":wrap", ()):
-            children = f(props, children)
+            for f in props.get(":textreplace", ()):
+                props, children = f(props, children)
+            for f in props.get(":join", ())[-1:]:
+                children = f(props, children)
+            for f in props.get(":wrap", ()):
+                children = f(props, children)
 
-        node = TextNode(props, children)
+            node = TextNode(props, children)
+            out.append(node)
+            if fragments is not None and description.fragment_key is not None:
+                fragments.store(description.fragment_key, node)
 
-    return node
+    return rval[0]
 
 
 
+# Properties whose functions need all the children of a node, which
+# stream_text therefore generates whole.
+_whole_properties = (":textreplace", ":join", ":wrap")
+
+
+class _StreamedChildren(object):
+    # The children of a TextNode made by stream_text. They are
+    # generated as layouts look at them: getting child i walks the
+    # description up to it (see _TextStream.step).
+
+    def __init__(self, stream, source):
+        self.stream = stream
+        # The children of the DescriptionProcessor node, while they
+        # are being walked. When a child that is a Rest is processed,
+        # the children after it are removed (see rest_elision), so
+        # len() is exact for the children up to the last one we have.
+        self.source = source
+        # The children we have, but the first offset of them, which
+        # were dropped by consume()
+        self.items = []
+        self.offset = 0
+
+    def __len__(self):
+        if self.source is None:
+            return self.offset + len(self.items)
+        return len(self.source)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < self.offset:
+            raise IndexError("child %s was already consumed" % i)
+        items = self.items
+        while self.offset + len(items) <= i and self.source is not None:
+            self.stream.step()
+        return items[i - self.offset]
+
+    def __iter__(self):
+        i = 0
+        while i < len(self):
+            yield self[i]
+            i += 1
+
+    def consume(self):
+        # Like __iter__, but drops each child as it is taken. The
+        # children are still generated as needed, and the ones that
+        # were already looked at (e.g. by Group) are taken from items.
+        i = self.offset
+        while i < len(self):
+            child = self[i]
+            del self.items[:i + 1 - self.offset]
+            self.offset = i + 1
+            yield child
+            i += 1
+
+
+class _TextStream(object):
+    # Builds TextNodes from the events of DescriptionProcessor.walk,
+    # as they are needed.
+
+    def __init__(self, events):
+        self.events = events
+        # The children of the nodes being walked
+        self.stack = [_StreamedChildren(self, [None])]
+
+    def root(self):
+        return self.stack[0][0]
+
+    def step(self):
+        event, x = next(self.events)
+        items = self.stack[-1].items
+        if event == "enter":
+            children = _StreamedChildren(self, x.children)
+            items.append(TextNode(x.properties, children))
+            self.stack.append(children)
+        elif event == "exit":
+            self.stack.pop().source = None
+        elif event == "leaf":
+            items.append(x if isinstance(x, str) else str(x))
+        else:
+            items.append(generate_text(x))
+
+
+def stream_text(stream, rules, width = default_width):
+    """
+    Yields the same lines as iter_convert(generate_text(
+    DescriptionProcessor.process(stream, rules)), width), as soon as
+    each is complete. The description is processed and generated as
+    the lines are written (see DescriptionProcessor.walk), so the
+    first lines come out before the rest of it is even described.
+    A Group looks ahead at most the width of the output to decide if
+    it fits on a line, but the nodes that have one of _whole_properties
+    are generated whole. The builtin layouts drop the nodes they have
+    written (see consume), so only those on the path to the current
+    line are kept, along with those a Group looked ahead at, and the
+    children of nodes whose layout looks at them in another way.
+    """
+    return iter_convert(_TextStream(DescriptionProcessor.walk(
+        stream, rules, _whole_properties)).root(), width)
+
+
 class TerminalFormatter(Formatter):
 
-    def __init__(self, rules):
+    def __init__(self, rules, width = default_width, fragment_cache = False):
         self._rules = rules
+        self.width = width
+        # See FragmentCache
+        self.fragments = FragmentCache() if fragment_cache else None
         self.rules = RuleTree()
         self.add_rules(rules)
 
     def copy(self):
-        return type(self)(self._rules)
+        # The rules are not registered again (see RuleTree.overlay)
+        new = type(self)(RuleBuilder(), self.width,
+                         fragment_cache = self.fragments is not None)
+        new._rules = self._rules
+        new.rules = self.rules.overlay()
+        return new
 
     def add_rules(self, ruleset):
+        if self.fragments is not None:
+            self.fragments.clear()
         for selector, props in ruleset.rules:
             selector = escape_selector(selector)
             self.rules.register(selector, props)
 
+    def generate(self, stream):
+        expl = self.rules.matcher()
+        fragments = self.fragments
+        if fragments is not None:
+            fragments.check()
+        return generate_text(DescriptionProcessor.process(stream, expl, fragments),
+                             fragments)
+
     def translate(self, stream):
-        expl = RuleTreeExplorer({}, [(0, False, self.rules)])
-        txt = generate_text(DescriptionProcessor.process(stream, expl))
-        return fix_sgr_nesting(str(txt))
+        return "\n".join(iter_convert(self.generate(stream), self.width))
+
+    def translate_iter(self, stream):
+        # Yields the output line by line, as soon as each line is
+        # complete (see stream_text). Lines are separated by newlines
+        # but, as with translate, there is no newline after the last
+        # one. The fragment cache needs the whole tree, so when there
+        # is one, the lines only come once it is generated.
+        if self.fragments is None:
+            lines = stream_text(stream, self.rules.matcher(), self.width)
+        else:
+            lines = iter_convert(self.generate(stream), self.width)
+        sep = ""
+        for line in lines:
+            yield sep + line
+            sep = "\n"
 
 
 term = RuleBuilder()
@@ -329,9 +857,9 @@ term = RuleBuilder()
 # term.prop(".{@list}", "bold", True)
 # term.prop(".{@tuple}", "color", "red")
 
-term.prop(".{@list}", "layout", Join("[\n  ", ",\n  ", "\n]", True))
-term.prop(".{@tuple}", "layout", Join("(\n  ", ",\n  ", ",\n)", True))
-term.prop(".{@dict}", "layout", Join("{\n  ", ",\n  ", "\n}", True))
+term.prop(".{@list}", "layout", Group("[\n  ", ",\n  ", "\n]", "[", ", ", "]"))
+term.prop(".{@tuple}", "layout", Group("(\n  ", ",\n  ", ",\n)", "(", ", ", ",)"))
+term.prop(".{@dict}", "layout", Group("{\n  ", ",\n  ", "\n}", "{", ", ", "}"))
 term.prop(".{assoc}", "layout", Join("", ": ", "", False))
 
 # term.prop(".{@list}", "layout", Join("[", ",\n ", "]", True))
@@ -363,7 +891,18 @@ term.prop(".{assoc}", "layout", Join("", ": ", "", False))
 def std_terminal(out = sys.stdout,
                  descr = descr,
                  rules = None,
-                 layout = None):
+                 layout = None,
+                 flush_size = 0,
+                 budget = None,
+                 width = None,
+                 fragment_cache = False):
+
+    # With flush_size = 0, each line is written to out as soon as it
+    # is complete. Groups that fit in width are written on a single
+    # line; by default, width is the width of the terminal.
+
+    if width is None:
+        width = shutil.get_terminal_size().columns
 
     if layout is None:
         layout = term
@@ -372,6 +911,8 @@ def std_terminal(out = sys.stdout,
 
     pr = Printer(out,
                  descr,
-                 TerminalFormatter(layout))
+                 TerminalFormatter(layout, width, fragment_cache),
+                 flush_size = flush_size,
+                 budget = budget)
     return pr
 
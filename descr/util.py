@@ -1,4 +1,7 @@
 
+import functools
+from .classes import class_set, intern_classes
+from .format import undefer
 
 
 class Descriptor(object):
@@ -6,8 +9,10 @@ class Descriptor(object):
     __classes__ = frozenset({})
 
     def __init__(self, classes):
+        # The classes are interned (see intern_classes), so that e.g.
+        # all the cells of a table's column share the same set
         if classes:
-            self.classes = classes | self.__classes__
+            self.classes = intern_classes(classes | self.__classes__)
         else:
             self.classes = self.__classes__
 
@@ -55,7 +60,7 @@ class WithClasses(Descriptor):
         self.x = x
 
     def __descr__(self, recurse):
-        v = recurse(self.x)
+        v = undefer(recurse(self.x))
         if isinstance(v, (str, int, float)):
             v = [v]
         else:
@@ -63,6 +68,14 @@ class WithClasses(Descriptor):
         return [self.classes] + v
 
 
+@functools.lru_cache(maxsize = 1024)
+def _table_classes(prefix, i):
+    # {"R#3", "R#odd"}, {"C#0", "C#even"}, etc. Cached, since tables
+    # mostly reuse the same row and column numbers, but bounded, so
+    # that one large table doesn't keep its sets forever.
+    return class_set(prefix + str(i), prefix + ("odd" if i % 2 else "even"))
+
+
 class Table(Descriptor):
 
     __classes__ = frozenset({"table"})
@@ -97,12 +110,10 @@ class Table(Descriptor):
             newrow = []
             for j, (column, cc) in enumerate(zip(row, cclasses)):
                 newrow.append(WithClasses(column,
-                                          classes = {"C#"+str(j),
-                                                     "C#"+("odd" if j%2 else "even")}|cc))
+                                          classes = _table_classes("C#", j) | cc))
 
             self.elements.append(Group(newrow,
-                                       classes = {"R#"+str(i),
-                                                  "R#"+("odd" if i%2 else "even")}|rc))
+                                       classes = _table_classes("R#", i) | rc))
 
     def __descr__(self, recurse):
         return [self.classes] + list(map(recurse, self.elements))
@@ -157,7 +168,7 @@ class Description(Descriptor):
         self.description = description
 
     def __descr__(self, recurse):
-        d = self.description
+        d = undefer(self.description)
         if isinstance(d, (str, int, float)):
             return recurse(d)
         elif isinstance(d, (set, frozenset)):
@@ -0,0 +1,64 @@
+
+# Compares the time highlight.morsel and the older splicing algorithm
+# take for growing numbers of specifications, to show how they scale:
+# doubling n should roughly double the time of morsel, but quadruple
+# the time of _morsel_splice.
+#
+# Run from the root of the repository with:
+#     python examples/benchmarks/highlight.py
+
+import sys
+import time
+import random
+
+sys.path.insert(0, ".")
+from descr.highlight import morsel, _morsel_splice, highlight_lines
+
+
+def token_specs(n):
+    # n tokens of 1 to 8 characters separated by spaces, with a
+    # highlight around every tenth group of tokens.
+    r = random.Random(n)
+    specs = []
+    pos = 0
+    for i in range(n):
+        length = r.randint(1, 8)
+        specs.append((pos, pos + length, {"token"}))
+        if i % 10 == 0:
+            specs.append((pos, pos + length, {"hl1"}))
+        pos += length + 1
+    return specs
+
+def source_lines(n):
+    return ["    x = f(%s) + 1" % i for i in range(n)]
+
+
+def timeit(f, *args):
+    t = time.time()
+    f(*args)
+    return time.time() - t
+
+
+def main():
+    print("%8s %12s %12s" % ("n", "morsel", "splice"))
+    for n in (500, 1000, 2000, 4000, 8000):
+        specs = token_specs(n)
+        t1 = timeit(morsel, list(specs))
+        t2 = timeit(_morsel_splice, list(specs))
+        print("%8d %11.4fs %11.4fs" % (n, t1, t2))
+
+    print()
+    print("highlight_lines, one location per line")
+    for n in (1250, 2500, 5000, 10000):
+        lines = source_lines(n)
+        locations = []
+        pos = 0
+        for line in lines:
+            locations.append((pos + 4, pos + 5, {"hl1"}))
+            pos += len(line) + 1
+        t = timeit(highlight_lines, lines, locations, 1, 0)
+        print("%8d %11.4fs" % (n, t))
+
+
+if __name__ == "__main__":
+    main()
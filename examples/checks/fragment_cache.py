@@ -0,0 +1,53 @@
+
+# Checks that HTMLFormatter gives the same output with and without a
+# fragment cache, including when :inspect describes the HTML generated
+# for nodes whose children could come from the cache (in which case
+# they must not, or the inspected HTML shows escaped markup).
+#
+# Run from the root of the repository with:
+#     python examples/checks/fragment_cache.py
+
+import re
+import sys
+import random
+
+sys.path.insert(0, ".")
+from descr import HTMLFormatter, HTMLRuleBuilder, descr
+from descr.html import html_boxy
+from descr.format import describe
+
+
+def random_datum(r, depth = 0):
+    if depth > 3 or r.random() < 0.3:
+        return r.choice([1, 2, "a", "<b>", None, True])
+    n = r.randint(0, 4)
+    if r.random() < 0.5:
+        return [random_datum(r, depth + 1) for _ in range(n)]
+    return tuple(random_datum(r, depth + 1) for _ in range(n))
+
+def strip_style(html):
+    # The CSS is only output the first time a formatter is used
+    return re.sub(r"(?s)<style.*?</style>", "", html)
+
+
+def main():
+    rb = HTMLRuleBuilder()
+    rb.inspect(".{@tuple} .{@list}")
+    rules = html_boxy["dark"] + rb
+
+    cached = HTMLFormatter(rules, top = "t", fragment_cache = True)
+    failures = 0
+    for seed in range(300):
+        datum = random_datum(random.Random(seed))
+        plain = HTMLFormatter(rules, top = "t")
+        expected = strip_style(plain.translate(describe(datum, descr)))
+        result = strip_style(cached.translate(describe(datum, descr)))
+        if result != expected:
+            failures += 1
+            print("different output for %r" % (datum,))
+    print("%s failures" % failures)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name = 'descr',
     version = '0.1',
-    packages = ['descr', 'descr.html'],
+    packages = ['descr', 'descr.html', 'descr.terminal'],
     
     # Metadata
     author = 'Olivier Breuleux',